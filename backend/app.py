@@ -1,9 +1,13 @@
-from flask import Flask, send_from_directory
+# Cooperative modes have to patch the standard library before anything else is imported
+from config import Config
+from concurrency import monkey_patch, run_options
+monkey_patch(Config.SOCKETIO_ASYNC_MODE)
+
+from flask import Flask
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from mongoengine import connect
-from config import Config
 
 from routes.auth import auth
 from routes.posts import posts
@@ -11,9 +15,16 @@ from routes.users import users
 from routes.messages import messages
 from routes.notifications import notifications
 from socket_events import init_socket_events, set_socketio_instance
+from media import init_media, serve_upload
+from fanout import init_fanout
+from presence import init_presence
+from card_cache import init_card_cache
+from socket_queue import socketio_queue_options
+from serializers import init_json
 
 app = Flask(__name__)
 app.config.from_object(Config)
+init_json(app)
 
 # Configure CORS for development
 CORS(app, origins=[
@@ -31,9 +42,10 @@ socketio = SocketIO(app,
         "http://localhost:3000", 
         "http://127.0.0.1:3000"
     ],
-    async_mode='threading',
-    logger=True,
-    engineio_logger=True
+    async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+    logger=app.config['SOCKETIO_LOGGER'],
+    engineio_logger=app.config['SOCKETIO_LOGGER'],
+    **socketio_queue_options(app.config)
 )
 
 # เชื่อมต่อ MongoDB ด้วย mongoengine โดยตรง
@@ -43,10 +55,14 @@ connect(
     port=app.config["MONGODB_SETTINGS"]["port"]
 )
 
+# Start the background image processing pool
+init_media(app.config)
+init_card_cache(app.config)
+
 # Route to serve uploaded files
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return serve_upload(filename)
 
 # Register Blueprints
 app.register_blueprint(auth, url_prefix="/api/auth")
@@ -58,6 +74,8 @@ app.register_blueprint(notifications, url_prefix="/api/notifications")
 # Initialize socket events
 set_socketio_instance(socketio)
 init_socket_events(socketio)
+init_presence(socketio, app.config)
+init_fanout(socketio, app.config)
 
 if __name__ == "__main__":
-    socketio.run(app, debug=True, port=5001)
+    socketio.run(app, debug=True, port=5001, **run_options(app.config))
@@ -0,0 +1,172 @@
+# bench_serialization.py
+# Time to read and encode a feed page and a notifications page: full Documents with per-reference
+# dereferencing and the stdlib encoder, against projections, as_pymongo() and orjson
+# python bench_serialization.py --rounds 50 --likes 500  (uses its own database, dropped afterwards)
+import time
+import random
+import argparse
+import statistics
+from datetime import datetime, timedelta
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from mongoengine import connect, disconnect
+from config import Config
+from models import User, Post, Comment, Like, Notification
+from hydration import hydrate_posts, hydrate_notifications
+from pagination import paginate
+from serializers import NOTIFICATION_FIELDS, OrjsonProvider
+
+def seed(authors, posts, comments, likes, notifications):
+    """Feed posts carrying legacy embedded likes arrays, their comments, and one viewer's notifications"""
+    users = [User(username=f"bench{i}", email=f"bench{i}@example.com", password='x') for i in range(authors + 1)]
+    for user in users:
+        user.save()
+    viewer, authors = users[0], users[1:]
+
+    now = datetime.utcnow()
+    post_ids = []
+    raw_posts = Post._get_collection()
+    for i in range(posts):
+        author = random.choice(authors)
+        post_id = raw_posts.insert_one({
+            'author': author.id,
+            'images': [f"/uploads/bench_{i}_{n}.jpg" for n in range(3)],
+            'image_hashes': [],
+            'caption': f"Bench post {i} " * 5,
+            'location': '',
+            'likes_count': likes,
+            'comments_count': comments,
+            'status': 'ready',
+            'created_at': now - timedelta(minutes=i),
+            # What every post carried before likes moved to their own collection
+            'likes': [random.choice(authors).id for _ in range(likes)]
+        }).inserted_id
+        post_ids.append(post_id)
+        for n in range(comments):
+            Comment(author=random.choice(authors), post=post_id, content=f"Comment {n} " * 4,
+                    created_at=now - timedelta(minutes=i, seconds=n)).save()
+        if i % 2:
+            Like(user=viewer, post=post_id).save()
+
+    for i in range(notifications):
+        actors = random.sample(authors, min(3, len(authors)))
+        Notification(recipient=viewer, sender=actors[-1], actors=actors, actor_count=len(actors), event_count=len(actors),
+                     notification_type='like', post=random.choice(post_ids), created_at=now - timedelta(minutes=i)).save()
+    return viewer.id, post_ids
+
+def feed_before(post_ids, viewer_id):
+    """The feed as routes built it originally: full Documents, one query per reference"""
+    feed_posts = []
+    for post in Post.objects(id__in=post_ids):
+        comments = Comment.objects(post=post).order_by('-created_at').limit(3)
+        feed_posts.append({
+            "id": str(post.id),
+            "images": post.images,
+            "caption": post.caption,
+            "location": post.location,
+            "created_at": post.created_at.isoformat(),
+            "likes_count": post.likes_count,
+            "comments_count": post.comments_count,
+            "is_liked": Like.objects(user=viewer_id, post=post).first() is not None,
+            "comments": [{
+                "id": str(comment.id),
+                "content": comment.content,
+                "created_at": comment.created_at.isoformat(),
+                "likes_count": comment.likes_count,
+                "author": {
+                    "id": str(comment.author.id),
+                    "username": comment.author.username,
+                    "profile_picture": comment.author.profile_picture
+                }
+            } for comment in comments],
+            "author": {
+                "id": str(post.author.id),
+                "username": post.author.username,
+                "profile_picture": post.author.profile_picture
+            }
+        })
+    return feed_posts
+
+def feed_after(post_ids, viewer_id):
+    return hydrate_posts(post_ids, viewer_id)
+
+def notifications_before(viewer_id, per_page):
+    notifications_data = []
+    for notification in Notification.objects(recipient=viewer_id).order_by('-created_at').limit(per_page):
+        notification_data = {
+            "id": str(notification.id),
+            "type": notification.notification_type,
+            "created_at": notification.created_at.isoformat(),
+            "is_read": notification.is_read,
+            "sender": {
+                "id": str(notification.sender.id),
+                "username": notification.sender.username,
+                "profile_picture": notification.sender.profile_picture
+            }
+        }
+        if notification.post:
+            notification_data["post"] = {"id": str(notification.post.id), "images": notification.post.images[:1]}
+        notifications_data.append(notification_data)
+    return notifications_data
+
+def notifications_after(viewer_id, per_page):
+    notifications = list(paginate(Notification.objects(recipient=viewer_id), None, per_page).only(
+        *NOTIFICATION_FIELDS
+    ).as_pymongo())
+    return hydrate_notifications(notifications, Config.NOTIFICATION_ACTORS_SHOWN)
+
+def measure(build, provider, rounds):
+    """Per-round milliseconds spent building the page and encoding the response body"""
+    build_ms, encode_ms = [], []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        payload = build()
+        built = time.perf_counter()
+        provider.response(payload).get_data()
+        build_ms.append((built - started) * 1000)
+        encode_ms.append((time.perf_counter() - built) * 1000)
+    return build_ms, encode_ms
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Feed and notification serialization cost, before and after")
+    parser.add_argument('--db', default='social_media_bench')
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--authors', type=int, default=50)
+    parser.add_argument('--posts', type=int, default=10, help="Posts on the feed page")
+    parser.add_argument('--comments', type=int, default=20, help="Comments per post")
+    parser.add_argument('--likes', type=int, default=500, help="Legacy embedded likes per post")
+    parser.add_argument('--notifications', type=int, default=20, help="Notifications on the page")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    connection = connect(db=args.db, host=Config.MONGODB_SETTINGS['host'], port=Config.MONGODB_SETTINGS['port'])
+    connection.drop_database(args.db)
+
+    try:
+        with app.app_context():
+            viewer_id, post_ids = seed(args.authors, args.posts, args.comments, args.likes, args.notifications)
+            stdlib, fast = DefaultJSONProvider(app), OrjsonProvider(app)
+            runs = [
+                ("feed before", lambda: feed_before(post_ids, viewer_id), stdlib),
+                ("feed after", lambda: feed_after(post_ids, viewer_id), fast),
+                ("notifications before", lambda: notifications_before(viewer_id, args.notifications), stdlib),
+                ("notifications after", lambda: notifications_after(viewer_id, args.notifications), fast),
+            ]
+
+            print(f"{args.posts} feed posts ({args.comments} comments, {args.likes} legacy likes each), "
+                  f"{args.notifications} notifications, {args.rounds} rounds")
+            print(f"{'page':<22} {'build p50':>10} {'build p95':>10} {'encode p50':>11} {'total p50':>10}")
+            for name, build, provider in runs:
+                provider.response(build())  # Warm up connections and caches
+                build_ms, encode_ms = measure(build, provider, args.rounds)
+                total_ms = [b + e for b, e in zip(build_ms, encode_ms)]
+                print(f"{name:<22} {statistics.median(build_ms):>10.2f} {percentile(build_ms, 95):>10.2f} "
+                      f"{statistics.median(encode_ms):>11.3f} {statistics.median(total_ms):>10.2f}")
+    finally:
+        connection.drop_database(args.db)
+        disconnect()
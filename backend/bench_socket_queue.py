@@ -0,0 +1,82 @@
+# bench_socket_queue.py
+# Delivery latency of Socket.IO emits from one API worker to N socket worker processes
+# through the local broker: python bench_socket_queue.py --workers 1 2 4 8
+import time
+import argparse
+import statistics
+import multiprocessing as mp
+import socketio
+from socket_queue import start_local_broker, LocalSocketManager
+
+class LatencyManager(LocalSocketManager):
+    """Records when each queued emit reaches this process instead of sending it to clients"""
+
+    def __init__(self, url, results):
+        super().__init__(url)
+        self.results = results
+
+    def _handle_emit(self, message):
+        self.results.put((time.time() - message['data']['sent_at']) * 1000)
+
+def run_worker(url, results):
+    manager = LatencyManager(url, results)
+    server = socketio.Server(client_manager=manager, async_mode='threading')
+    server.manager_initialized = True
+    manager.initialize()
+    while True:
+        time.sleep(1)
+
+def measure(broker, url, workers, messages, interval):
+    results = mp.Queue()
+    processes = [mp.Process(target=run_worker, args=(url, results), daemon=True) for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    # Wait until every worker has subscribed
+    deadline = time.time() + 10
+    while len(broker.subscribers) < workers and time.time() < deadline:
+        time.sleep(0.05)
+
+    publisher = LocalSocketManager(url, write_only=True)
+    for _ in range(messages):
+        publisher.emit('bench', {'sent_at': time.time()}, namespace='/', room='bench')
+        time.sleep(interval)
+
+    latencies = []
+    try:
+        for _ in range(messages * workers):
+            latencies.append(results.get(timeout=5))
+    except Exception:
+        pass
+
+    for process in processes:
+        process.terminate()
+        process.join()
+
+    # Give the broker a moment to drop the closed subscribers
+    deadline = time.time() + 5
+    while broker.subscribers and time.time() < deadline:
+        time.sleep(0.05)
+    return latencies
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Socket.IO message queue delivery latency")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--interval', type=float, default=0.002, help="Seconds between emits")
+    args = parser.parse_args()
+
+    broker, url = start_local_broker()
+    print(f"Broker at {url}, {args.messages} emits per run")
+    print(f"{'workers':>8} {'delivered':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for workers in args.workers:
+        latencies = measure(broker, url, workers, args.messages, args.interval)
+        if not latencies:
+            print(f"{workers:>8} {0:>10} (no deliveries)")
+            continue
+        print(f"{workers:>8} {len(latencies):>10} {statistics.median(latencies):>8.2f} "
+              f"{percentile(latencies, 95):>8.2f} {percentile(latencies, 99):>8.2f} {max(latencies):>8.2f}")
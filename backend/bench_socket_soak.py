@@ -0,0 +1,238 @@
+# bench_socket_soak.py
+# Connection soak: hold N idle websockets against the real app in each async mode and
+# compare server memory, threads and event latency: python bench_socket_soak.py --clients 1000 5000
+import os
+import sys
+import time
+import json
+import base64
+import struct
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import statistics
+import subprocess
+
+# Run in a fresh interpreter so app.py can monkey patch before anything else is imported
+SERVER = """
+import sys
+from app import app, socketio
+from concurrency import run_options
+
+@socketio.on('soak_echo')
+def soak_echo(data):
+    return data
+
+socketio.run(app, host='127.0.0.1', port=int(sys.argv[1]), debug=False, log_output=False,
+             allow_unsafe_werkzeug=True, **run_options(app.config))
+"""
+
+def _frame(text):
+    """Masked websocket text frame, as clients must send"""
+    payload = text.encode()
+    mask = os.urandom(4)
+    size = len(payload)
+    if size < 126:
+        header = struct.pack('!BB', 0x81, 0x80 | size)
+    elif size < 65536:
+        header = struct.pack('!BBH', 0x81, 0x80 | 126, size)
+    else:
+        header = struct.pack('!BBQ', 0x81, 0x80 | 127, size)
+    return header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+async def _read_frame(reader):
+    first, second = await reader.readexactly(2)
+    size = second & 0x7f
+    if size == 126:
+        (size,) = struct.unpack('!H', await reader.readexactly(2))
+    elif size == 127:
+        (size,) = struct.unpack('!Q', await reader.readexactly(8))
+    return first & 0x0f, await reader.readexactly(size)
+
+class SoakClient:
+    """Bare Engine.IO v4 websocket client: enough to connect, answer pings and echo"""
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.acks = {}
+        self.next_ack = 0
+        self.alive = False
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write((
+            f"GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+        ).encode())
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in head.split(b'\r\n', 1)[0]:
+            raise ConnectionError(head.split(b'\r\n', 1)[0].decode())
+
+        # Engine.IO open packet, then the Socket.IO namespace connect
+        _, packet = await _read_frame(self.reader)
+        if not packet.startswith(b'0'):
+            raise ConnectionError("No Engine.IO open packet")
+        self.writer.write(_frame('40'))
+        while True:
+            _, packet = await _read_frame(self.reader)
+            if packet.startswith(b'40'):
+                break
+            if packet.startswith(b'44'):
+                raise ConnectionError(packet.decode())
+        self.alive = True
+        asyncio.ensure_future(self._listen())
+
+    async def _listen(self):
+        try:
+            while True:
+                opcode, packet = await _read_frame(self.reader)
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    self.writer.write(struct.pack('!BB', 0x8a, 0x80) + os.urandom(4))
+                elif packet == b'2':
+                    self.writer.write(_frame('3'))
+                elif packet.startswith(b'43'):
+                    ack_id = int(packet[2:packet.index(b'[')])
+                    future = self.acks.pop(ack_id, None)
+                    if future and not future.done():
+                        future.set_result(time.perf_counter())
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        self.alive = False
+
+    async def echo(self, timeout):
+        """Round trip of one acknowledged event, in milliseconds"""
+        ack_id = self.next_ack
+        self.next_ack += 1
+        future = asyncio.get_running_loop().create_future()
+        self.acks[ack_id] = future
+        started = time.perf_counter()
+        self.writer.write(_frame(f'42{ack_id}' + json.dumps(['soak_echo', {'n': ack_id}])))
+        finished = await asyncio.wait_for(future, timeout)
+        return (finished - started) * 1000
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+def process_stats(pid):
+    """Resident memory in MB and OS thread count of a process"""
+    stats = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            stats[key] = value.strip()
+    return int(stats['VmRSS'].split()[0]) / 1024, int(stats['Threads'])
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def soak(port, clients, hold, ramp, server_pid):
+    limit = asyncio.Semaphore(ramp)
+    connect_ms = []
+    failures = []
+
+    async def open_one():
+        async with limit:
+            client = SoakClient()
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(client.connect('127.0.0.1', port), 15)
+                connect_ms.append((time.perf_counter() - started) * 1000)
+                return client
+            except Exception as e:
+                failures.append(type(e).__name__)
+                client.close()
+                return None
+
+    opened = [c for c in await asyncio.gather(*(open_one() for _ in range(clients))) if c]
+
+    # Hold the sockets idle, sampling event round trips while every connection stays open
+    echo_ms = []
+    timeouts = 0
+    deadline = time.time() + hold
+    while time.time() < deadline:
+        live = [c for c in opened if c.alive]
+        sample = random.sample(live, min(50, len(live)))
+        results = await asyncio.gather(*(c.echo(5) for c in sample), return_exceptions=True)
+        echo_ms.extend(r for r in results if isinstance(r, float))
+        timeouts += sum(1 for r in results if isinstance(r, Exception))
+        await asyncio.sleep(1)
+
+    rss, threads = process_stats(server_pid)
+    alive = sum(1 for c in opened if c.alive)
+    for client in opened:
+        client.close()
+    return {
+        'connected': len(opened), 'failed': len(failures), 'alive': alive,
+        'connect_ms': connect_ms, 'echo_ms': echo_ms, 'echo_timeouts': timeouts,
+        'rss': rss, 'threads': threads
+    }
+
+def run_mode(mode, clients, hold, ramp):
+    port = free_port()
+    env = dict(os.environ, SOCKETIO_ASYNC_MODE=mode, SOCKETIO_LOGGER='0', PYTHONWARNINGS='ignore')
+    env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    server = subprocess.Popen([sys.executable, '-c', SERVER, str(port)], env=env,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_port(port):
+            return None
+        idle_rss, idle_threads = process_stats(server.pid)
+        result = asyncio.run(soak(port, clients, hold, ramp, server.pid))
+        result.update(idle_rss=idle_rss, idle_threads=idle_threads)
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Socket.IO idle connection soak per async mode")
+    parser.add_argument('--modes', nargs='+', default=['threading', 'eventlet', 'gevent'])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--hold', type=float, default=30, help="Seconds to hold the connections (pings every 25s)")
+    parser.add_argument('--ramp', type=int, default=100, help="Handshakes in flight at once")
+    args = parser.parse_args()
+
+    # Both ends need a descriptor per socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print(f"{'mode':>10} {'clients':>8} {'ok':>6} {'failed':>6} {'alive':>6} {'conn p50':>9} {'conn p99':>9} "
+          f"{'echo p50':>9} {'echo p99':>9} {'lost':>5} {'RSS MB':>7} {'KB/conn':>8} {'threads':>8}")
+    for clients in args.clients:
+        for mode in args.modes:
+            result = run_mode(mode, clients, args.hold, args.ramp)
+            if result is None:
+                print(f"{mode:>10} {clients:>8} server did not start")
+                continue
+            per_conn = (result['rss'] - result['idle_rss']) * 1024 / max(1, result['connected'])
+            print(f"{mode:>10} {clients:>8} {result['connected']:>6} {result['failed']:>6} {result['alive']:>6} "
+                  f"{statistics.median(result['connect_ms'] or [float('nan')]):>9.1f} {percentile(result['connect_ms'], 99):>9.1f} "
+                  f"{statistics.median(result['echo_ms'] or [float('nan')]):>9.2f} {percentile(result['echo_ms'], 99):>9.2f} "
+                  f"{result['echo_timeouts']:>5} {result['rss']:>7.0f} {per_conn:>8.1f} {result['threads']:>8}")
@@ -0,0 +1,152 @@
+# card_cache.py
+# Read-through cache of public user cards (id, username, profile_picture), in this process or shared through Redis
+import json
+import time
+import threading
+from collections import OrderedDict
+
+_backend = None
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_stats_lock = threading.Lock()
+
+class MemoryCardCache:
+    """Bounded LRU with a TTL, per worker process"""
+    shared = False
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user id -> (expires_at, card)
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get_many(self, user_ids):
+        now = time.monotonic()
+        cards = {}
+        with self.lock:
+            for user_id in user_ids:
+                entry = self.entries.get(user_id)
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    del self.entries[user_id]
+                    continue
+                self.entries.move_to_end(user_id)
+                cards[user_id] = entry[1]
+        return cards
+
+    def set_many(self, cards):
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            for user_id, card in cards.items():
+                self.entries[user_id] = (expires_at, card)
+                self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+    def info(self):
+        return {"size": len(self.entries), "capacity": self.size, "evictions": self.evictions}
+
+class RedisCardCache:
+    """Cache shared by every worker, so an invalidation reaches all of them at once
+
+    Cards are JSON strings under card:<user_id> with a TTL; Redis' maxmemory policy does the bounding.
+    """
+    shared = True
+
+    def __init__(self, url, ttl):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def _key(self, user_id):
+        return f"card:{user_id}"
+
+    def get_many(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        values = self.redis.mget([self._key(user_id) for user_id in user_ids])
+        return {user_id: json.loads(value) for user_id, value in zip(user_ids, values) if value is not None}
+
+    def set_many(self, cards):
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, card in cards.items():
+            pipe.set(self._key(user_id), json.dumps(card), ex=self.ttl)
+        pipe.execute()
+
+    def delete(self, user_ids):
+        if user_ids:
+            self.redis.delete(*[self._key(user_id) for user_id in user_ids])
+
+    def info(self):
+        return {"size": None, "capacity": None, "evictions": None}
+
+def init_card_cache(config):
+    """Pick the backend from USER_CARD_CACHE_BACKEND"""
+    global _backend
+    if _backend is not None:
+        return
+    url = config.get('USER_CARD_CACHE_BACKEND') or 'memory'
+    if url == 'memory':
+        _backend = MemoryCardCache(config['USER_CARD_CACHE_SIZE'], config['USER_CARD_CACHE_TTL'])
+    else:
+        _backend = RedisCardCache(url, config['USER_CARD_CACHE_TTL'])
+
+def _count(stat, amount):
+    with _stats_lock:
+        _stats[stat] += amount
+
+def get_cards(user_ids, load):
+    """Cards for string user_ids, calling load(missing ids) -> {id: card} for the ones not cached
+
+    Without init_card_cache (scripts, benchmarks) every call goes to load.
+    """
+    user_ids = set(user_ids)
+    if _backend is None:
+        return load(user_ids) if user_ids else {}
+
+    try:
+        cards = _backend.get_many(user_ids)
+    except Exception as e:
+        print(f"Error reading user card cache: {e}")
+        cards = {}
+    missing = user_ids - set(cards)
+    _count('hits', len(cards))
+    _count('misses', len(missing))
+
+    if missing:
+        loaded = load(missing)
+        try:
+            _backend.set_many(loaded)
+        except Exception as e:
+            print(f"Error writing user card cache: {e}")
+        cards.update(loaded)
+    return cards
+
+def invalidate_cards(*user_ids):
+    """Drop cards after a username or profile picture change"""
+    if _backend is None:
+        return
+    _count('invalidations', len(user_ids))
+    try:
+        _backend.delete([str(user_id) for user_id in user_ids])
+    except Exception as e:
+        print(f"Error invalidating user card cache: {e}")
+
+def card_cache_stats():
+    """Hit/miss counters for this process, plus the backend's size where it can report one"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else None
+    stats['backend'] = None if _backend is None else ('shared' if _backend.shared else 'memory')
+    if _backend is not None:
+        stats.update(_backend.info())
+    return stats
@@ -0,0 +1,40 @@
+# concurrency.py
+# Server concurrency model: one OS thread per connection, or eventlet/gevent green threads
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+
+_async_mode = 'threading'
+
+def monkey_patch(async_mode):
+    """Make the standard library cooperative for green-thread modes
+
+    Must run before Flask, pymongo or anything that imports socket/threading,
+    otherwise MongoDB connections and locks created at import time would block
+    the whole hub instead of yielding.
+    """
+    global _async_mode
+    if async_mode not in ASYNC_MODES:
+        raise ValueError(f"Unsupported SOCKETIO_ASYNC_MODE {async_mode!r}, expected one of {', '.join(ASYNC_MODES)}")
+    if async_mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif async_mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    _async_mode = async_mode
+
+def run_blocking(func, *args, **kwargs):
+    """Run CPU-bound work (password hashing) on a real OS thread so green threads keep serving sockets"""
+    if _async_mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(func, *args, **kwargs)
+    if _async_mode == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
+
+def run_options(config):
+    """Extra socketio.run() arguments for the configured async mode"""
+    if config['SOCKETIO_ASYNC_MODE'] == 'eventlet':
+        # eventlet.wsgi stops accepting after 1024 simultaneous connections unless told otherwise
+        return {'max_size': config['SOCKETIO_MAX_CONNECTIONS']}
+    return {}
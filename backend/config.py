@@ -10,9 +10,87 @@ class Config:
         'port': 27017
     }
     UPLOAD_FOLDER = 'uploads'
+    RAW_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, 'raw')  # Unprocessed uploads waiting for the image workers
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    UPLOAD_MAX_CONTENT_LENGTH = 64 * 1024 * 1024  # Streamed multipart uploads are spooled to disk, not memory
+    UPLOAD_MAX_FILE_SIZE = 10 * 1024 * 1024  # Per image in a multipart upload
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
     
+    # Feed timeline: authors with more followers than this are pulled at read time instead of fanned out
+    FEED_FANOUT_FOLLOWER_LIMIT = 5000
+    FEED_BACKFILL_POSTS = 20  # Recent posts copied into a timeline on follow
+    FEED_HIGH_FANOUT_CACHE_TTL = 60  # Seconds the set of pulled authors is reused across feed reads
+    
+    # Comment threads: a reply to a comment at this depth joins its parent's thread instead of nesting deeper
+    COMMENT_MAX_DEPTH = 2
+    
+    # Background image processing
+    IMAGE_WORKERS = 2  # Processes decoding and resizing uploads
+    IMAGE_QUEUE_LIMIT = 64  # Images waiting or in progress before uploads are rejected with 503
+    IMAGE_COMPLETION_THREADS = 4  # Publish/fan-out/emit work after a batch finishes
+    POST_IMAGE_SIZES = (150, 320, 640, 1080)  # Widths rendered for every post image, as JPEG and WebP
+    AVATAR_IMAGE_SIZES = (150, 400)
+    
+    # Socket.IO server: 'threading' costs an OS thread per socket; 'eventlet' or 'gevent' hold idle sockets as green threads
+    SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE') or 'threading'
+    SOCKETIO_LOGGER = os.environ.get('SOCKETIO_LOGGER') == '1'  # Per-frame Socket.IO/Engine.IO logging, for debugging only
+    SOCKETIO_MAX_CONNECTIONS = int(os.environ.get('SOCKETIO_MAX_CONNECTIONS') or 20000)  # Per process, cooperative modes
+    
+    # Response encoding: 'stdlib' (json module) or 'orjson' (optional dependency, several times faster on large pages)
+    JSON_BACKEND = os.environ.get('JSON_BACKEND') or 'stdlib'
+    
+    # Socket.IO across worker processes: redis://, amqp:// or local://host:port (socket_queue.LocalBroker)
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+    SOCKETIO_CHANNEL = 'socketio'
+    
+    # User documents cached per process for routes and sockets; invalidated locally on change,
+    # so other workers may serve a copy up to USER_CACHE_TTL seconds old
+    USER_CACHE_TTL = 30
+    USER_CACHE_SIZE = 10000
+    
+    # Public user cards (id, username, picture) for post/comment authors, senders and partners:
+    # 'memory' (per process, other workers may serve a card up to the TTL old) or a redis:// URL shared by every worker
+    USER_CARD_CACHE_BACKEND = os.environ.get('USER_CARD_CACHE_BACKEND') or 'memory'
+    USER_CARD_CACHE_SIZE = 50000  # Cards per process with the memory backend; size it from /api/users/cards/cache-stats
+    USER_CARD_CACHE_TTL = 300
+    # User ids allowed to read operational endpoints such as cache stats (comma-separated); empty keeps them hidden
+    OPS_USER_IDS = [user_id.strip() for user_id in (os.environ.get('OPS_USER_IDS') or '').split(',') if user_id.strip()]
+    
+    # Grouped notifications: activities of one kind on one target within a bucket share a document
+    NOTIFICATION_BUCKET_HOURS = 24
+    NOTIFICATION_ACTORS_KEPT = 20  # Recent actors stored per group, for names and de-duplication
+    NOTIFICATION_ACTORS_SHOWN = 2  # Named in "A, B and 9,998 others"
+    
+    # Username search
+    SEARCH_CANDIDATES = 100  # Prefix matches fetched and ranked per query
+    SEARCH_RESULTS = 20
+    SEARCH_CACHE_TTL = 30  # Seconds a prefix's candidates are reused across viewers and keystrokes
+    SEARCH_CACHE_SIZE = 1000
+    SEARCH_MUTUAL_SAMPLE = 200  # Most recent follows of the viewer counted for "followed by people you follow"
+    
+    # Follow suggestions, precomputed by `manage.py refresh-suggestions` (run it from cron)
+    SUGGESTIONS_STORED = 30  # Candidates kept per user, so a few follows still leave a full list
+    SUGGESTIONS_SHOWN = 10
+    SUGGESTIONS_FOLLOWING_SAMPLE = 500  # Most recent follows walked for friends-of-friends
+    SUGGESTIONS_ACTIVE_DAYS = 14  # Posts in this window count as recent activity
+    SUGGESTIONS_ACTIVITY_WEIGHT = 0.5  # Score per recent post, capped at SUGGESTIONS_ACTIVITY_CAP posts
+    SUGGESTIONS_ACTIVITY_CAP = 6
+    SUGGESTIONS_FOLLOWS_YOU_BONUS = 2  # Accounts that already follow the user
+    
+    # Presence: 'memory' (per process) or a redis:// URL shared by every worker
+    PRESENCE_BACKEND = os.environ.get('PRESENCE_BACKEND') or 'memory'
+    PRESENCE_TTL = 90  # Seconds a shared entry survives without its worker refreshing it
+    
+    # Real-time fan-out to followers
+    FANOUT_COALESCE_SECONDS = 2.0  # Repeated updates for the same user/post within this window are sent once
+    FANOUT_BATCH_SIZE = 500  # Follower rooms per emit
+    
+    # Serving /uploads: None streams from Flask, 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd) delegate to the front server
+    MEDIA_SENDFILE_MODE = os.environ.get('MEDIA_SENDFILE_MODE') or None
+    MEDIA_ACCEL_PREFIX = '/protected-uploads'  # nginx internal location aliased to UPLOAD_FOLDER
+    MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+    USE_X_SENDFILE = MEDIA_SENDFILE_MODE == 'x-sendfile'
+    
     # Create upload folder if it doesn't exist
     if not os.path.exists(UPLOAD_FOLDER):
         os.makedirs(UPLOAD_FOLDER)
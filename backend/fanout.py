@@ -0,0 +1,88 @@
+# fanout.py
+# Real-time fan-out of updates to followers, run off the request thread
+import time
+import threading
+from bson import ObjectId
+from models import User, Follow
+from follows import follower_ids
+from presence import online_user_ids, reachable_among
+
+_socketio = None
+_config = None
+_pending = {}  # coalescing key -> (event, user_id, payload, due_at)
+_lock = threading.Lock()
+_wakeup = threading.Event()
+
+def init_fanout(socketio, config):
+    """Start the dispatcher as a SocketIO background task"""
+    global _socketio, _config
+    if _socketio is not None:
+        return
+    _socketio = socketio
+    _config = config
+    socketio.start_background_task(_run)
+
+def dispatch(event, user_id, payload, key):
+    """Queue an event for every connected follower of user_id
+
+    Repeated dispatches with the same key inside FANOUT_COALESCE_SECONDS
+    collapse into one delivery carrying the latest payload.
+    """
+    if _socketio is None:
+        print("Fan-out dispatcher not initialized")
+        return
+    with _lock:
+        existing = _pending.get(key)
+        due_at = existing[3] if existing else time.monotonic() + _config['FANOUT_COALESCE_SECONDS']
+        _pending[key] = (event, user_id, payload, due_at)
+    _wakeup.set()
+
+def _run():
+    while True:
+        # Sleep until the earliest pending key is due, or until something new arrives
+        with _lock:
+            next_due = min((item[3] for item in _pending.values()), default=None)
+        timeout = None if next_due is None else max(0, next_due - time.monotonic())
+        _wakeup.wait(timeout=timeout)
+        _wakeup.clear()
+
+        now = time.monotonic()
+        with _lock:
+            due = [key for key, item in _pending.items() if item[3] <= now]
+            ready = [_pending.pop(key) for key in due]
+
+        for event, user_id, payload, _ in ready:
+            try:
+                _deliver(event, user_id, payload)
+            except Exception as e:
+                print(f"Error fanning out {event} for user {user_id}: {e}")
+
+def _deliver(event, user_id, payload):
+    """Emit to followers' rooms in batches, skipping followers who are offline"""
+    batch_size = _config['FANOUT_BATCH_SIZE']
+    online_ids = online_user_ids()
+    followers_count = User.objects(id=user_id).scalar('followers_count').first() or 0
+
+    if online_ids is not None and len(online_ids) < followers_count:
+        # Fewer users online than followers: check the online users against the follow index instead
+        for start in range(0, len(online_ids), batch_size):
+            chunk = [ObjectId(online_id) for online_id in online_ids[start:start + batch_size] if ObjectId.is_valid(online_id)]
+            edges = Follow.objects(follower__in=chunk, followee=user_id).only('follower').as_pymongo()
+            rooms = [f"user_{edge['follower']}" for edge in edges]
+            if rooms:
+                _socketio.emit(event, payload, to=rooms)
+        return
+
+    batch = []
+    for follower_id in follower_ids(user_id):
+        batch.append(follower_id)
+        if len(batch) >= batch_size:
+            _emit_reachable(event, payload, batch)
+            batch = []
+    if batch:
+        _emit_reachable(event, payload, batch)
+
+def _emit_reachable(event, payload, user_ids):
+    rooms = [f"user_{reachable_id}" for reachable_id in reachable_among(user_ids)]
+    if rooms:
+        _socketio.emit(event, payload, to=rooms)
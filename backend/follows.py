@@ -0,0 +1,55 @@
+# follows.py
+# Follow graph stored as edges in the follows collection, with counters on User
+from mongoengine.errors import NotUniqueError
+from models import User, Follow
+from hydration import ref_id
+from user_cache import invalidate_user
+
+def follow(follower_id, followee_id):
+    """Create the edge; returns False if it already existed"""
+    try:
+        Follow(follower=ref_id(follower_id), followee=ref_id(followee_id)).save(force_insert=True)
+    except NotUniqueError:
+        return False
+    User.objects(id=ref_id(follower_id)).update_one(inc__following_count=1)
+    User.objects(id=ref_id(followee_id)).update_one(inc__followers_count=1)
+    invalidate_user(follower_id, followee_id)
+    return True
+
+def unfollow(follower_id, followee_id):
+    """Remove the edge; returns False if there was nothing to remove"""
+    removed = Follow.objects(follower=ref_id(follower_id), followee=ref_id(followee_id)).delete()
+    if not removed:
+        return False
+    User.objects(id=ref_id(follower_id)).update_one(dec__following_count=1)
+    User.objects(id=ref_id(followee_id)).update_one(dec__followers_count=1)
+    invalidate_user(follower_id, followee_id)
+    return True
+
+def is_following(follower_id, followee_id):
+    """Single indexed lookup on the unique (follower, followee) edge"""
+    return Follow.objects(follower=ref_id(follower_id), followee=ref_id(followee_id)).only('id').first() is not None
+
+def following_among(follower_id, user_ids):
+    """Return which of user_ids the follower follows, as ObjectIds"""
+    ids = [ref_id(user_id) for user_id in user_ids]
+    if not ids:
+        return set()
+    edges = Follow.objects(follower=ref_id(follower_id), followee__in=ids).only('followee').as_pymongo()
+    return {edge['followee'] for edge in edges}
+
+def following_ids(user_id):
+    """ObjectIds of everyone the user follows"""
+    edges = Follow.objects(follower=ref_id(user_id)).only('followee').as_pymongo()
+    return [edge['followee'] for edge in edges]
+
+def recent_following_ids(user_id, limit):
+    """ObjectIds of the accounts the user followed most recently, at most limit of them"""
+    edges = Follow.objects(follower=ref_id(user_id)).order_by('-created_at', '-id').only('followee').limit(limit).as_pymongo()
+    return [edge['followee'] for edge in edges]
+
+def follower_ids(user_id, batch_size=1000):
+    """ObjectIds of everyone following the user, streamed from the reverse index"""
+    edges = Follow.objects(followee=ref_id(user_id)).only('follower').as_pymongo().batch_size(batch_size)
+    for edge in edges:
+        yield edge['follower']
@@ -0,0 +1,151 @@
+# hydration.py
+# Batched loaders that resolve every reference on a page with one query per collection
+from flask import current_app
+from models import User, Post, Comment, Like
+from serializers import USER_CARD_FIELDS, user_card, post_renditions, serialize_comment
+from card_cache import get_cards
+
+def ref_id(value):
+    """Return the ObjectId behind a Document, DBRef or raw ObjectId"""
+    if value is None:
+        return None
+    return getattr(value, 'id', value)
+
+def load_user_cards(user_ids):
+    """Resolve user ids to cards keyed by string id: cached cards first, one $in query for the rest"""
+    ids = {str(ref_id(user_id)) for user_id in user_ids if user_id is not None}
+    return get_cards(ids, query_user_cards)
+
+def query_user_cards(user_ids):
+    users = User.objects(id__in=list(user_ids)).only(*USER_CARD_FIELDS).as_pymongo()
+    return {str(user['_id']): user_card(user) for user in users}
+
+def load_post_previews(post_ids):
+    """Resolve post ids to their first image with a single $in query, keyed by string id"""
+    ids = {ref_id(post_id) for post_id in post_ids if post_id is not None}
+    if not ids:
+        return {}
+    sizes = current_app.config['POST_IMAGE_SIZES']
+    posts = Post.objects(id__in=list(ids)).only('images', 'image_hashes').as_pymongo()
+
+    previews = {}
+    for post in posts:
+        renditions = post_renditions(post.get('image_hashes', [])[:1], sizes)
+        # Previews are thumbnails, so point at the smallest rendition when there is one
+        images = [renditions[0][str(min(sizes))]['jpeg']] if renditions else post.get('images', [])[:1]
+        previews[str(post['_id'])] = {
+            "id": str(post['_id']),
+            "images": images,
+            "image_renditions": renditions
+        }
+    return previews
+
+def liked_post_ids(user_id, post_ids):
+    """Return the subset of post_ids the user has liked, as ObjectIds"""
+    if not post_ids:
+        return set()
+    likes = Like.objects(user=ref_id(user_id), post__in=post_ids).only('post').as_pymongo()
+    return {like['post'] for like in likes}
+
+def feed_posts_pipeline(post_ids, comments_per_post):
+    """Posts in post_ids with their most recent top-level comments joined in"""
+    return [
+        {'$match': {'_id': {'$in': list(post_ids)}}},
+        {'$lookup': {
+            'from': Comment._get_collection_name(),
+            'let': {'post_id': '$_id'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$post', '$$post_id']}, 'parent': None}},
+                {'$sort': {'created_at': -1}},
+                {'$limit': comments_per_post},
+                {'$project': {
+                    'author': 1,
+                    'content': 1,
+                    'created_at': 1,
+                    'likes_count': 1,
+                    'replies_count': 1
+                }}
+            ],
+            'as': 'recent_comments'
+        }},
+        {'$project': {
+            'author': 1,
+            'images': 1,
+            'image_hashes': 1,
+            'caption': 1,
+            'location': 1,
+            'created_at': 1,
+            'recent_comments': 1,
+            'likes_count': 1,
+            'comments_count': 1
+        }}
+    ]
+
+def hydrate_posts(post_ids, viewer_id, comments_per_post=3):
+    """Load and serialize feed posts in post_ids order
+
+    Posts and their most recent comments come back from one aggregation,
+    authors of both from one $in query and the viewer's likes from another.
+    """
+    if not post_ids:
+        return []
+
+    pipeline = feed_posts_pipeline(post_ids, comments_per_post)
+    posts = {post['_id']: post for post in Post._get_collection().aggregate(pipeline)}
+
+    author_ids = []
+    for post in posts.values():
+        author_ids.append(post['author'])
+        author_ids.extend(comment['author'] for comment in post['recent_comments'])
+    cards = load_user_cards(author_ids)
+    liked = liked_post_ids(viewer_id, list(posts.keys()))
+
+    feed_posts = []
+    for post_id in post_ids:
+        post = posts.get(post_id)
+        if not post:
+            continue
+        feed_posts.append({
+            "id": str(post['_id']),
+            "images": post.get('images', []),
+            "image_renditions": post_renditions(post.get('image_hashes')),
+            "caption": post.get('caption', ''),
+            "location": post.get('location', ''),
+            "created_at": post['created_at'].isoformat(),
+            "likes_count": post.get('likes_count', 0),
+            "comments_count": post.get('comments_count', 0),
+            "is_liked": post['_id'] in liked,
+            "comments": [serialize_comment(comment, cards) for comment in post['recent_comments']],
+            "author": cards.get(str(post['author']))
+        })
+    return feed_posts
+
+def hydrate_notifications(notifications, actors_shown):
+    """Serialize raw notification documents, resolving actors and post previews for the whole page at once"""
+    for notification in notifications:
+        # Latest actor first; ungrouped notifications from before aggregation only have a sender
+        earlier = [actor for actor in reversed(notification.get('actors') or []) if actor != notification['sender']]
+        notification['shown_actors'] = ([notification['sender']] + earlier)[:actors_shown]
+    cards = load_user_cards(actor for notification in notifications for actor in notification['shown_actors'])
+    previews = load_post_previews(notification.get('post') for notification in notifications)
+
+    notifications_data = []
+    for notification in notifications:
+        notification_data = {
+            "id": str(notification['_id']),
+            "type": notification['notification_type'],
+            "created_at": notification['created_at'].isoformat(),
+            "is_read": notification.get('is_read', False),
+            "sender": cards.get(str(notification['sender'])),
+            "actors": [cards[str(actor)] for actor in notification['shown_actors'] if str(actor) in cards],
+            "actor_count": notification.get('actor_count', 1),
+            "event_count": notification.get('event_count', 1)
+        }
+
+        # Add post info if available
+        post_preview = previews.get(str(notification.get('post')))
+        if post_preview:
+            notification_data["post"] = post_preview
+
+        notifications_data.append(notification_data)
+    return notifications_data
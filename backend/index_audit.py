@@ -0,0 +1,204 @@
+# index_audit.py
+# Explain every query shape and aggregation the app issues and report collection scans and in-memory sorts
+from datetime import datetime
+from bson import ObjectId
+from models import User, Follow, Post, Comment, Like, Message, Conversation, TimelineEntry, Notification, UnreadCounter, UserSuggestions
+from pagination import paginate, paginate_after, encode_cursor
+from timeline import UNPUBLISHED
+from hydration import feed_posts_pipeline
+from search import mutual_counts_pipeline
+from suggestions import friends_of_friends_pipeline, recent_post_counts_pipeline
+
+MODELS = [User, Follow, Post, Comment, Like, Message, Conversation, TimelineEntry, Notification, UnreadCounter, UserSuggestions]
+
+# Stages that mean the query reads more than it returns
+BAD_STAGES = {
+    'COLLSCAN': "collection scan",
+    'SORT': "in-memory sort"
+}
+
+# Stages a shape is known to need, with the reason
+ACCEPTED_STAGES = {
+    # Top-N by followers_count within the prefix's index range; short prefixes are served from search's cache
+    "user search": {'SORT'},
+    # Offline full pass over every message, run with allowDiskUse
+    "rebuild conversations": {'COLLSCAN', 'SORT'}
+}
+
+def query_shapes():
+    """(name, queryset) for each query in routes/ and the modules they call
+
+    Values are placeholders; the planner picks the same plan for any value of the same shape.
+    """
+    user_id, other_id, post_id = ObjectId(), ObjectId(), ObjectId()
+    cursor = encode_cursor(datetime.utcnow(), ObjectId())
+    conversation_id = Conversation.key_for(user_id, other_id)
+
+    return [
+        # auth / users
+        ("login by username", User.objects(username='someone')),
+        ("login by email", User.objects(email='someone@example.com')),
+        ("username taken by another user", User.objects(username='someone', id__ne=user_id)),
+        ("email taken by another user", User.objects(email='someone@example.com', id__ne=user_id)),
+        ("user cards", User.objects(id__in=[user_id, other_id]).only('username', 'profile_picture')),
+        ("high-fanout authors", User.objects(is_high_fanout=True).only('id')),
+        ("user search", User.objects(username_lower__startswith='ab').order_by('-followers_count').limit(100)),
+        ("user search exact match", User.objects(username_lower='ab')),
+        ("stored suggestions", UserSuggestions.objects(id=user_id).only('candidates')),
+        ("suggestion cards", User.objects(id__in=[user_id, other_id]).only('username', 'profile_picture', 'bio', 'followers_count')),
+        ("popular accounts", User.objects.order_by('-followers_count').only('id').limit(60)),
+        ("suggestion sample", Follow.objects(follower=user_id).order_by('-created_at', '-id').only('followee').limit(500)),
+        ("suggestions follow back", Follow.objects(follower__in=[user_id, other_id], followee=post_id)),
+
+        # follows
+        ("is following", Follow.objects(follower=user_id, followee=other_id)),
+        ("following among", Follow.objects(follower=user_id, followee__in=[other_id, post_id])),
+        ("following ids", Follow.objects(follower=user_id)),
+        ("follower ids", Follow.objects(followee=user_id)),
+        ("online followers", Follow.objects(follower__in=[user_id, other_id], followee=post_id)),
+        ("following page", paginate(Follow.objects(follower=user_id), cursor, 20)),
+        ("followers page", paginate(Follow.objects(followee=user_id), cursor, 20)),
+
+        # feed and posts
+        ("timeline page", paginate(TimelineEntry.objects(owner=user_id), None, 10, id_field='post')),
+        ("timeline next page", paginate(TimelineEntry.objects(owner=user_id), cursor, 10, id_field='post')),
+        ("timeline unfollow cleanup", TimelineEntry.objects(owner=user_id, author=other_id)),
+        ("pulled feed posts", paginate(Post.objects(author__in=[user_id, other_id], status__nin=UNPUBLISHED), cursor, 10)),
+        ("timeline backfill", Post.objects(author=user_id, status__nin=UNPUBLISHED).order_by('-created_at').limit(20)),
+        ("profile posts", paginate(Post.objects(author=user_id, status__nin=UNPUBLISHED), cursor, 12)),
+        ("own profile posts", paginate(Post.objects(author=user_id), None, 12)),
+        ("liked among posts", Like.objects(user=user_id, post__in=[post_id, other_id])),
+        ("like toggle", Like.objects(user=user_id, post=post_id)),
+        ("post comments page", paginate(Comment.objects(post=post_id, parent=None), cursor, 20)),
+        ("latest comments per post", Comment.objects(post=post_id, parent=None).order_by('-created_at', '-id').limit(3)),
+        ("comment replies", Comment.objects(parent=post_id).order_by('created_at', 'id').limit(20)),
+        ("comment replies next page", paginate_after(Comment.objects(parent=post_id), cursor, 20)),
+        ("reply parent", Comment.objects(id=post_id, post=other_id)),
+
+        # messages
+        ("conversation inbox", Conversation.objects(participants=user_id).order_by('-last_message_at')),
+        ("conversation summary", Conversation.objects(conversation_id=conversation_id)),
+        ("message history", paginate(Message.objects(conversation_id=conversation_id), cursor, 50)),
+        ("message deltas", paginate_after(Message.objects(conversation_id=conversation_id), cursor, 50)),
+        ("mark conversation read", Message.objects(sender=other_id, receiver=user_id, is_read=False)),
+
+        # notifications
+        ("notifications page", paginate(Notification.objects(recipient=user_id), cursor, 20)),
+        ("unread notifications", Notification.objects(recipient=user_id, is_read=False)),
+        ("mark notifications read", Notification.objects(id__in=[post_id], recipient=user_id, is_read=False)),
+        ("notification group", Notification.objects(recipient=user_id, group_key='follow', bucket=datetime.utcnow())),
+    ]
+
+def pipeline_shapes():
+    """(name, model, pipeline) for each aggregation, built by the same functions the app calls"""
+    # manage imports this module, so its pipelines are only importable once this one has loaded
+    from manage import conversation_summary_pipeline
+    user_id, other_id, post_id = ObjectId(), ObjectId(), ObjectId()
+
+    return [
+        ("feed posts", Post, feed_posts_pipeline([post_id, other_id], 3)),
+        ("search mutual follows", Follow, mutual_counts_pipeline([user_id, other_id], [post_id])),
+        ("suggestions friends of friends", Follow, friends_of_friends_pipeline([user_id, other_id], [post_id], 120)),
+        ("suggestions recent posts", Post, recent_post_counts_pipeline([user_id, other_id], datetime.utcnow())),
+        ("rebuild conversations", Message, conversation_summary_pipeline()),
+    ]
+
+def bind(value, variables):
+    """Copy of a pipeline with $$variable references replaced by placeholder values"""
+    if isinstance(value, str):
+        return variables.get(value, value)
+    if isinstance(value, dict):
+        return {key: bind(item, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [bind(item, variables) for item in value]
+    return value
+
+def lookup_shapes(name, pipeline):
+    """(name, collection, pipeline) for each $lookup sub-pipeline, as it runs for one joined document"""
+    for stage in pipeline:
+        lookup = stage.get('$lookup')
+        if not lookup or 'pipeline' not in lookup:
+            continue
+        inner = bind(lookup['pipeline'], {f"$${variable}": ObjectId() for variable in lookup.get('let', {})})
+        inner_name = f"{name} -> {lookup['from']}"
+        yield inner_name, lookup['from'], inner
+        yield from lookup_shapes(inner_name, inner)
+
+def plan_stages(plan):
+    """Every stage name in an explain() result, across classic and slot-based plan formats"""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+def flagged_stages(plan):
+    """BAD_STAGES in a plan, except a SORT of $group output, which orders groups rather than documents"""
+    flagged = []
+    if isinstance(plan, dict):
+        children = [value for key, value in plan.items() if key != 'stage']
+        stage = plan.get('stage')
+        if stage in BAD_STAGES and not (stage == 'SORT' and 'GROUP' in plan_stages(children)):
+            flagged.append(stage)
+        for value in children:
+            flagged.extend(flagged_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            flagged.extend(flagged_stages(value))
+    return flagged
+
+def winning_plan(explain):
+    planner = explain.get('queryPlanner', {})
+    plan = planner.get('winningPlan', {})
+    # Slot-based engine nests the tree under queryPlan
+    return plan.get('queryPlan', plan)
+
+def aggregate_plans(explain):
+    """Winning plans of an aggregate explain: pushed down into the query layer, or under a leading $cursor stage"""
+    plans = []
+    if 'queryPlanner' in explain:
+        plans.append(winning_plan(explain))
+    for stage in explain.get('stages', []):
+        if '$cursor' in stage:
+            plans.append(winning_plan(stage['$cursor']))
+    return plans
+
+def explain_aggregate(db, collection, pipeline):
+    return db.command('aggregate', collection, pipeline=pipeline, explain=True)
+
+def audit(verbose=False):
+    """Create declared indexes, explain every query shape and aggregation and return the problems found"""
+    problems = []
+
+    for model in MODELS:
+        model.ensure_indexes()
+        drift = model.compare_indexes()
+        for spec in drift.get('missing', []):
+            problems.append(f"{model.__name__}: declared index {spec} is missing")
+        for spec in drift.get('extra', []):
+            problems.append(f"{model.__name__}: index {spec} exists but is no longer declared")
+
+    def check(name, collection, plans):
+        accepted = ACCEPTED_STAGES.get(name, set())
+        flagged = [f"{BAD_STAGES[stage]} ({stage})" for stage in flagged_stages(plans) if stage not in accepted]
+        if flagged:
+            problems.append(f"{name}: {', '.join(flagged)} on {collection}")
+        if verbose:
+            print(f"{'!!' if flagged else 'ok'} {name}: {' <- '.join(plan_stages(plans))}")
+
+    for name, queryset in query_shapes():
+        check(name, queryset._document.__name__, [winning_plan(queryset.explain())])
+
+    for name, model, pipeline in pipeline_shapes():
+        db = model._get_db()
+        check(name, model.__name__, aggregate_plans(explain_aggregate(db, model._get_collection_name(), pipeline)))
+        # $lookup sub-pipelines run once per joined document and never show up in the outer plan
+        for inner_name, collection, inner in lookup_shapes(name, pipeline):
+            check(inner_name, collection, aggregate_plans(explain_aggregate(db, collection, inner)))
+
+    return problems
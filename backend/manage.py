@@ -0,0 +1,222 @@
+# manage.py
+# Maintenance commands: python manage.py <command>
+import sys
+import argparse
+from mongoengine import connect
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from flask import Flask
+from config import Config
+from index_audit import audit
+from suggestions import refresh_all
+from timeline import UNPUBLISHED, rebuild_timeline
+from models import User, Follow, Post, Comment, Like, Message, Conversation, UnreadCounter
+
+def migrate_likes():
+    """Move embedded Post.likes/Post.comments arrays into the likes collection and counters"""
+    posts = Post._get_collection()
+    likes = Like._get_collection()
+    migrated = 0
+
+    for post in posts.find({'$or': [{'likes': {'$exists': True}}, {'comments': {'$exists': True}}]}, {'likes': 1}):
+        liked_at = post['_id'].generation_time.replace(tzinfo=None)
+        like_docs = [{'user': user_id, 'post': post['_id'], 'created_at': liked_at} for user_id in post.get('likes', [])]
+        if like_docs:
+            try:
+                likes.insert_many(like_docs, ordered=False)
+            except BulkWriteError:
+                pass  # Likes already migrated by a previous run
+
+        posts.update_one({'_id': post['_id']}, {
+            '$set': {
+                'likes_count': likes.count_documents({'post': post['_id']}),
+                'comments_count': Comment.objects(post=post['_id']).count()
+            },
+            '$unset': {'likes': '', 'comments': ''}
+        })
+        migrated += 1
+
+    # Comment likes were never exposed beyond their count
+    comments = Comment._get_collection()
+    updates = [UpdateOne({'_id': comment['_id']}, {
+        '$set': {'likes_count': len(comment['likes'])},
+        '$unset': {'likes': ''}
+    }) for comment in comments.find({'likes': {'$exists': True}}, {'likes': 1})]
+    if updates:
+        comments.bulk_write(updates, ordered=False)
+
+    print(f"Migrated {migrated} posts and {len(updates)} comments")
+
+def conversation_summary_pipeline():
+    """Latest message and per-participant unread counts for every pair that has messages"""
+    return [
+        {'$sort': {'created_at': -1}},
+        {'$group': {
+            '_id': {
+                'low': {'$cond': [{'$lt': ['$sender', '$receiver']}, '$sender', '$receiver']},
+                'high': {'$cond': [{'$lt': ['$sender', '$receiver']}, '$receiver', '$sender']}
+            },
+            'last_message_content': {'$first': '$content'},
+            'last_sender': {'$first': '$sender'},
+            'last_message_at': {'$first': '$created_at'},
+            # Unread messages addressed to the lower and higher participant respectively
+            'unread_low': {'$sum': {'$cond': [
+                {'$and': [{'$eq': ['$is_read', False]}, {'$lt': ['$receiver', '$sender']}]}, 1, 0
+            ]}},
+            'unread_high': {'$sum': {'$cond': [
+                {'$and': [{'$eq': ['$is_read', False]}, {'$gt': ['$receiver', '$sender']}]}, 1, 0
+            ]}}
+        }}
+    ]
+
+def rebuild_conversations():
+    """Rebuild conversation summaries from the messages collection with one $group pass"""
+    pipeline = conversation_summary_pipeline()
+
+    updates = []
+    for group in Message._get_collection().aggregate(pipeline, allowDiskUse=True):
+        low, high = group['_id']['low'], group['_id']['high']
+        unread_counts = {str(low): group['unread_low'], str(high): group['unread_high']}
+        updates.append(UpdateOne({'conversation_id': Conversation.key_for(low, high)}, {'$set': {
+            'participants': [low, high],
+            'last_message_content': group['last_message_content'],
+            'last_sender': group['last_sender'],
+            'last_message_at': group['last_message_at'],
+            'unread_counts': unread_counts
+        }}, upsert=True))
+
+    if updates:
+        Conversation._get_collection().bulk_write(updates, ordered=False)
+    print(f"Rebuilt {len(updates)} conversations")
+
+def backfill_conversation_ids():
+    """Set Message.conversation_id on messages written before it existed"""
+    sender, receiver = {'$toString': '$sender'}, {'$toString': '$receiver'}
+    result = Message._get_collection().update_many({'conversation_id': {'$exists': False}}, [
+        {'$set': {'conversation_id': {'$cond': [
+            {'$lt': [sender, receiver]},
+            {'$concat': [sender, '_', receiver]},
+            {'$concat': [receiver, '_', sender]}
+        ]}}}
+    ])
+    print(f"Backfilled {result.modified_count} messages")
+
+def migrate_follows():
+    """Move embedded User.following arrays into follow edges and recompute the counters"""
+    users = User._get_collection()
+    edges = Follow._get_collection()
+
+    for user in users.find({'following': {'$exists': True}}, {'following': 1}):
+        followed_at = user['_id'].generation_time.replace(tzinfo=None)
+        docs = [{'follower': user['_id'], 'followee': followee_id, 'created_at': followed_at}
+                for followee_id in user.get('following', [])]
+        if docs:
+            try:
+                edges.insert_many(docs, ordered=False)
+            except BulkWriteError:
+                pass  # Edges already migrated by a previous run
+
+    # Counters come from the edges, so the command is safe to re-run
+    updates = [UpdateOne({'_id': user['_id']}, {'$set': {'followers_count': 0, 'following_count': 0}})
+               for user in users.find({}, {'_id': 1})]
+    for field, counter in (('followee', 'followers_count'), ('follower', 'following_count')):
+        for group in edges.aggregate([{'$group': {'_id': f'${field}', 'count': {'$sum': 1}}}], allowDiskUse=True):
+            updates.append(UpdateOne({'_id': group['_id']}, {'$set': {counter: group['count']}}))
+    if updates:
+        users.bulk_write(updates, ordered=True)
+
+    users.update_many({}, {'$unset': {'followers': '', 'following': ''}})
+    # High-fanout status is sticky, so only ever set it here
+    users.update_many(
+        {'followers_count': {'$gt': Config.FEED_FANOUT_FOLLOWER_LIMIT}},
+        {'$set': {'is_high_fanout': True}}
+    )
+    print(f"Migrated follow graph: {edges.estimated_document_count()} edges")
+
+    # Feeds are read from timelines only, so materialize them for the migrated edges
+    rebuild_timelines()
+
+def backfill_username_lower():
+    """Set User.username_lower on accounts created before prefix search"""
+    result = User._get_collection().update_many(
+        {'username_lower': {'$exists': False}},
+        [{'$set': {'username_lower': {'$toLower': '$username'}}}]
+    )
+    print(f"Backfilled {result.modified_count} users")
+
+def backfill_posts_count():
+    """Recount User.posts_count from published posts"""
+    pipeline = [
+        {'$match': {'status': {'$nin': UNPUBLISHED}}},
+        {'$group': {'_id': '$author', 'count': {'$sum': 1}}}
+    ]
+    counts = {group['_id']: group['count'] for group in Post._get_collection().aggregate(pipeline)}
+    users = User._get_collection()
+    users.update_many({}, {'$set': {'posts_count': 0}})
+    writes = [UpdateOne({'_id': author}, {'$set': {'posts_count': count}}) for author, count in counts.items()]
+    if writes:
+        users.bulk_write(writes, ordered=False)
+    print(f"Backfilled post counts for {len(writes)} authors")
+
+def reset_unread_counters():
+    """Drop the cached unread counters; each is rebuilt from the source collections on next use
+
+    Run after rebuild-conversations or any bulk change to read state.
+    """
+    removed = UnreadCounter.objects.delete()
+    print(f"Removed {removed} unread counters")
+
+def audit_indexes():
+    """Explain every query shape; exits non-zero on collection scans, in-memory sorts or index drift"""
+    problems = audit(verbose=True)
+    for problem in problems:
+        print(f"PROBLEM {problem}")
+    if problems:
+        sys.exit(1)
+    print("Every query shape is served by an index")
+
+def app_context():
+    """Flask app context for commands whose modules read settings from current_app.config"""
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    return app.app_context()
+
+def rebuild_timelines():
+    """Materialize feed timelines for users whose follows predate fan-out; safe to re-run"""
+    with app_context():
+        rebuilt = 0
+        for user in User.objects.only('id').as_pymongo():
+            rebuild_timeline(user['_id'])
+            rebuilt += 1
+    print(f"Rebuilt timelines for {rebuilt} users")
+
+def refresh_suggestions():
+    """Recompute every user's follow suggestions; schedule periodically, e.g. hourly from cron"""
+    with app_context():
+        refreshed = refresh_all()
+    print(f"Refreshed suggestions for {refreshed} users")
+
+COMMANDS = {
+    'audit-indexes': audit_indexes,
+    'backfill-conversation-ids': backfill_conversation_ids,
+    'backfill-posts-count': backfill_posts_count,
+    'backfill-username-lower': backfill_username_lower,
+    'migrate-follows': migrate_follows,
+    'migrate-likes': migrate_likes,
+    'rebuild-conversations': rebuild_conversations,
+    'rebuild-timelines': rebuild_timelines,
+    'refresh-suggestions': refresh_suggestions,
+    'reset-unread-counters': reset_unread_counters
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Social backend maintenance commands")
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    args = parser.parse_args()
+
+    connect(
+        db=Config.MONGODB_SETTINGS["db"],
+        host=Config.MONGODB_SETTINGS["host"],
+        port=Config.MONGODB_SETTINGS["port"]
+    )
+    COMMANDS[args.command]()
@@ -0,0 +1,285 @@
+# media.py
+# Image decoding and resizing in a bounded process pool, off the request thread
+import os
+import re
+import uuid
+import mimetypes
+import base64
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image
+from flask import current_app, request, send_from_directory, abort
+from werkzeug.security import safe_join
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+
+# Encoder options per output format
+RENDITION_FORMATS = {
+    'jpeg': {'quality': 85, 'optimize': True},
+    'webp': {'quality': 80, 'method': 4}
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = None
+_completions = None  # Runs batch callbacks off the process pool's result-handling thread
+
+class ProcessingBusy(Exception):
+    """Raised when the image processing queue is full"""
+
+def init_media(config):
+    """Create the worker pool and the queue bound from the app config"""
+    global _executor, _slots, _completions
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=config['IMAGE_WORKERS'])
+            _slots = threading.BoundedSemaphore(config['IMAGE_QUEUE_LIMIT'])
+            _completions = ThreadPoolExecutor(max_workers=config['IMAGE_COMPLETION_THREADS'], thread_name_prefix='image-complete')
+        os.makedirs(config['RAW_UPLOAD_FOLDER'], exist_ok=True)
+
+def decode_image_data(image_data):
+    """Decode a base64 (optionally data URL) image string to bytes"""
+    if image_data.startswith('data:image'):
+        image_data = image_data.split(',')[1]
+    return base64.b64decode(image_data)
+
+def store_raw(raw_folder, image_bytes):
+    """Persist uploaded bytes untouched so the request can return quickly
+
+    Returns the raw file path and the content hash used to name its renditions.
+    """
+    raw_path = os.path.join(raw_folder, f"{uuid.uuid4().hex}.raw")
+    with open(raw_path, 'wb') as f:
+        f.write(image_bytes)
+    return raw_path, hashlib.sha256(image_bytes).hexdigest()
+
+class SpooledUpload:
+    """Writable file for one multipart part that lands directly in the raw folder, hashed as it streams"""
+
+    def __init__(self, raw_folder, max_size):
+        self.path = os.path.join(raw_folder, f"{uuid.uuid4().hex}.raw")
+        self.size = 0
+        self._max_size = max_size
+        self._hash = hashlib.sha256()
+        self._file = open(self.path, 'w+b')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self._max_size:
+            raise RequestEntityTooLarge("Image exceeds the maximum upload size")
+        self._hash.update(data)
+        return self._file.write(data)
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+    def discard(self):
+        self.close()
+        discard_files([self.path])
+
+    def __getattr__(self, name):
+        # seek/read/close etc. go to the underlying file
+        return getattr(self._file, name)
+
+def parse_streamed_upload(environ, config, fields):
+    """Parse a multipart request without buffering file parts in memory
+
+    Each file part is written to RAW_UPLOAD_FOLDER chunk by chunk, capped at
+    UPLOAD_MAX_FILE_SIZE. Parts under names other than fields are deleted once
+    parsed, so only what the caller takes stays on disk.
+    Returns (form, {field: [(raw_path, digest), ...]}).
+    """
+    spooled = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        spool = SpooledUpload(config['RAW_UPLOAD_FOLDER'], config['UPLOAD_MAX_FILE_SIZE'])
+        spooled.append(spool)
+        return spool
+
+    try:
+        _, form, files = parse_form_data(
+            environ,
+            stream_factory=stream_factory,
+            max_content_length=config['UPLOAD_MAX_CONTENT_LENGTH'],
+            max_form_memory_size=64 * 1024,
+            silent=False
+        )
+    except Exception:
+        for spool in spooled:
+            spool.discard()
+        raise
+
+    uploads = {}
+    for field, storage in files.items(multi=True):
+        spool = storage.stream
+        if spool.size == 0 or field not in fields:
+            # An empty file input still produces a part; other fields have no consumer
+            spool.discard()
+            continue
+        spool.close()
+        uploads.setdefault(field, []).append((spool.path, spool.digest))
+    return form, uploads
+
+def rendition_filename(digest, size, fmt):
+    """Content-addressed file name of one rendition"""
+    extension = 'jpg' if fmt == 'jpeg' else fmt
+    return f"img_{digest}_{size}.{extension}"
+
+def rendition_map(digest, sizes):
+    """srcset-style map of width -> {format: url} for a content hash"""
+    return {
+        str(size): {fmt: f"/uploads/{rendition_filename(digest, size, fmt)}" for fmt in RENDITION_FORMATS}
+        for size in sizes
+    }
+
+def primary_url(digest, sizes):
+    """URL of the largest JPEG rendition, used where a single image URL is expected"""
+    return f"/uploads/{rendition_filename(digest, max(sizes), 'jpeg')}"
+
+def renditions_exist(upload_folder, digest, sizes):
+    """True if every rendition of this content is already on disk"""
+    return all(
+        os.path.exists(os.path.join(upload_folder, rendition_filename(digest, size, fmt)))
+        for size in sizes for fmt in RENDITION_FORMATS
+    )
+
+def render_renditions(raw_path, upload_folder, digest, sizes):
+    """Decode once and write every size as JPEG and WebP (runs in a worker process)"""
+    try:
+        with Image.open(raw_path) as img:
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            # Largest first so each smaller size is resampled from the previous one
+            for size in sorted(sizes, reverse=True):
+                img.thumbnail((size, size), Image.Resampling.LANCZOS)
+                for fmt, options in RENDITION_FORMATS.items():
+                    output_path = os.path.join(upload_folder, rendition_filename(digest, size, fmt))
+                    # Write to a temp name so readers never see a partial file
+                    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+                    img.save(tmp_path, fmt.upper(), **options)
+                    os.replace(tmp_path, output_path)
+        return digest
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+def submit_batch(upload_folder, uploads, sizes, on_complete):
+    """Render (raw_path, digest) uploads and call on_complete(errors) once all finish
+
+    Content that already has renditions on disk is not processed again.
+    Raises ProcessingBusy without queuing anything if the pool is saturated;
+    images that cannot be submitted for any other reason are reported to on_complete as errors.
+    """
+    tasks = []
+    for raw_path, digest in uploads:
+        if renditions_exist(upload_folder, digest, sizes):
+            discard_files([raw_path])
+        else:
+            tasks.append((raw_path, digest))
+
+    if not tasks:
+        on_complete([])
+        return
+
+    acquired = 0
+    for _ in tasks:
+        if not _slots.acquire(blocking=False):
+            for _ in range(acquired):
+                _slots.release()
+            raise ProcessingBusy("Image processing queue is full")
+        acquired += 1
+
+    remaining = [len(tasks)]
+    errors = []
+    lock = threading.Lock()
+
+    def finish_one(error):
+        with lock:
+            if error is not None:
+                errors.append(error)
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            # on_complete writes to Mongo, fans out and emits; keep that off the pool's management thread
+            _completions.submit(run_on_complete)
+
+    def run_on_complete():
+        try:
+            on_complete(errors)
+        except Exception as e:
+            print(f"Error finishing image batch: {e}")
+
+    def task_done(future):
+        _slots.release()
+        finish_one(future.exception())
+
+    for index, (raw_path, digest) in enumerate(tasks):
+        try:
+            future = _executor.submit(render_renditions, raw_path, upload_folder, digest, sizes)
+        except Exception as e:
+            # Pool broken or shut down: give back the slots of everything not submitted and
+            # fail those images, so the batch still completes (and its post is marked failed)
+            print(f"Error submitting image batch: {e}")
+            unsubmitted = tasks[index:]
+            discard_files(path for path, _ in unsubmitted)
+            for _ in unsubmitted:
+                _slots.release()
+                finish_one(e)
+            return
+        future.add_done_callback(task_done)
+
+def discard_files(paths):
+    """Best-effort removal of raw or rendered files"""
+    for path in paths:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError:
+            pass
+
+def remove_upload(upload_folder, url):
+    """Delete a single-owner upload; content-addressed renditions may be shared and are kept"""
+    filename = os.path.basename(url)
+    if filename.startswith('img_'):
+        return
+    discard_files([os.path.join(upload_folder, filename)])
+
+CONTENT_ADDRESSED = re.compile(r'^img_([0-9a-f]{64})_(\d+)\.(jpg|webp)$')
+
+def upload_etag(filename, path):
+    """Strong ETag: the content hash for renditions, size and mtime for older uploads"""
+    match = CONTENT_ADDRESSED.match(filename)
+    if match:
+        return f"{match.group(1)[:32]}-{match.group(2)}-{match.group(3)}"
+    stat = os.stat(path)
+    return f"{int(stat.st_mtime)}-{stat.st_size}"
+
+def serve_upload(filename):
+    """Serve an uploaded file with immutable caching, ETags, 304s and ranges
+
+    MEDIA_SENDFILE_MODE 'x-accel' or 'x-sendfile' hands the byte transfer to the
+    fronting server so Python workers only produce headers.
+    """
+    config = current_app.config
+    path = safe_join(config['UPLOAD_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    etag = upload_etag(filename, path)
+
+    if config['MEDIA_SENDFILE_MODE'] == 'x-accel':
+        response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{config['MEDIA_ACCEL_PREFIX'].rstrip('/')}/{filename}"
+        response.set_etag(etag)
+        response.make_conditional(request)
+    else:
+        # send_file handles If-None-Match/304 and Range; USE_X_SENDFILE covers 'x-sendfile'
+        response = send_from_directory(config['UPLOAD_FOLDER'], filename, etag=etag, max_age=config['MEDIA_MAX_AGE'])
+
+    # Upload names never change content, so clients and CDNs can keep them forever
+    response.cache_control.public = True
+    response.cache_control.max_age = config['MEDIA_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
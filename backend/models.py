@@ -1,24 +1,39 @@
 # models.py
-from mongoengine import Document, StringField, ReferenceField, DateTimeField, ListField, BooleanField, IntField, ImageField
+from mongoengine import Document, StringField, ReferenceField, DateTimeField, ListField, BooleanField, IntField, ImageField, DictField, ObjectIdField
 from datetime import datetime
 import hashlib
 
 class User(Document):
     username = StringField(required=True, unique=True)
+    username_lower = StringField()  # Normalized copy for anchored prefix search, set in clean()
     email = StringField(required=True, unique=True)
     password = StringField(required=True)
     profile_picture = StringField(default="")
     bio = StringField(max_length=150, default="")
-    followers = ListField(ReferenceField('self'), default=[])
-    following = ListField(ReferenceField('self'), default=[])
+    followers_count = IntField(default=0)  # Maintained with $inc alongside the follows collection
+    following_count = IntField(default=0)
+    posts_count = IntField(default=0)  # Published posts, incremented when a post's images finish processing
+    is_high_fanout = BooleanField(default=False)  # Sticky once followers_count passes FEED_FANOUT_FOLLOWER_LIMIT: posts are pulled, not fanned out
     created_at = DateTimeField(default=datetime.utcnow)
     is_verified = BooleanField(default=False)
+    last_seen = DateTimeField()  # Set by presence.py when a socket opens and when the last one closes
     
     meta = {
         'collection': 'users',
-        'indexes': ['username', 'email']
+        'strict': False,  # Tolerate legacy embedded followers/following arrays until migrated
+        'indexes': [
+            'username',
+            'email',
+            ('username_lower', '-followers_count'),  # Prefix search shortlist, most followed first
+            '-followers_count',  # Popular accounts for suggestions
+            {'fields': ['is_high_fanout'], 'partialFilterExpression': {'is_high_fanout': True}}  # Pulled feed authors
+        ]
     }
     
+    def clean(self):
+        if self.username:
+            self.username_lower = self.username.lower()
+    
     def set_password(self, password):
         """Hash and set the password"""
         self.password = hashlib.sha256(password.encode()).hexdigest()
@@ -27,30 +42,56 @@ class User(Document):
         """Check if the provided password matches the stored hash"""
         return self.password == hashlib.sha256(password.encode()).hexdigest()
 
+class Follow(Document):
+    follower = ReferenceField(User, required=True)
+    followee = ReferenceField(User, required=True)
+    created_at = DateTimeField(default=datetime.utcnow)
+    
+    meta = {
+        'collection': 'follows',
+        'indexes': [
+            {'fields': ['follower', 'followee'], 'unique': True},
+            ('follower', '-created_at', '-id'),
+            ('followee', '-created_at', '-id')
+        ]
+    }
+
 class Post(Document):
     author = ReferenceField(User, required=True)
     images = ListField(StringField(), required=True)  # URLs to images
+    image_hashes = ListField(StringField(), default=[])  # Content hashes naming each image's renditions
     caption = StringField(default="")
-    likes = ListField(ReferenceField(User), default=[])
-    comments = ListField(ReferenceField('Comment'), default=[])
+    likes_count = IntField(default=0)  # Maintained with $inc alongside the likes collection
+    comments_count = IntField(default=0)
     created_at = DateTimeField(default=datetime.utcnow)
     location = StringField(default="")
+    status = StringField(default='ready', choices=('processing', 'ready', 'failed'))  # Image processing state
     
     meta = {
         'collection': 'posts',
-        'indexes': ['author', 'created_at']
+        'strict': False,  # Tolerate legacy embedded likes/comments arrays until migrated
+        'indexes': [('author', '-created_at', '-id')]  # Profile grids, backfills and pulled feed posts
     }
 
 class Comment(Document):
     author = ReferenceField(User, required=True)
     post = ReferenceField(Post, required=True)
     content = StringField(required=True)
-    likes = ListField(ReferenceField(User), default=[])
+    likes_count = IntField(default=0)
     created_at = DateTimeField(default=datetime.utcnow)
     
+    # Threads: replies point at their parent, and depth stops at COMMENT_MAX_DEPTH
+    parent = ReferenceField('self')  # None for top-level comments
+    depth = IntField(default=0)
+    replies_count = IntField(default=0)  # Direct replies, maintained with $inc
+    
     meta = {
         'collection': 'comments',
-        'indexes': ['post', 'created_at']
+        'strict': False,
+        'indexes': [
+            ('post', 'parent', '-created_at', '-id'),  # Top-level comment pages and latest comments per post
+            ('parent', 'created_at', 'id')  # Replies, oldest first
+        ]
     }
 
 class Like(Document):
@@ -60,19 +101,64 @@ class Like(Document):
     
     meta = {
         'collection': 'likes',
-        'indexes': ['user', 'post']
+        'indexes': [
+            {'fields': ['user', 'post'], 'unique': True},
+            'post'
+        ]
     }
 
 class Message(Document):
     sender = ReferenceField(User, required=True)
     receiver = ReferenceField(User, required=True)
     content = StringField(required=True)
+    conversation_id = StringField()  # Conversation.key_for(sender, receiver)
     is_read = BooleanField(default=False)
     created_at = DateTimeField(default=datetime.utcnow)
     
     meta = {
         'collection': 'messages',
-        'indexes': ['sender', 'receiver', 'created_at']
+        'indexes': [
+            ('conversation_id', '-created_at', '-id'),  # History pages
+            ('receiver', 'sender', 'is_read')  # Marking a partner's messages read
+        ]
+    }
+    
+    def clean(self):
+        """Derive the conversation key from the participants"""
+        if not self.conversation_id:
+            self.conversation_id = Conversation.key_for(self.sender.id, self.receiver.id)
+
+class Conversation(Document):
+    conversation_id = StringField(required=True, unique=True)  # Sorted id pair, matches the chat room name
+    participants = ListField(ReferenceField(User), required=True)
+    last_message_content = StringField(default="")
+    last_sender = ReferenceField(User)
+    last_message_at = DateTimeField(default=datetime.utcnow)
+    unread_counts = DictField(default={})  # user id -> messages that user has not read yet
+    
+    meta = {
+        'collection': 'conversations',
+        'indexes': [('participants', '-last_message_at')]
+    }
+    
+    @staticmethod
+    def key_for(user_id, partner_id):
+        """Canonical conversation key for a pair of users"""
+        return "_".join(sorted([str(user_id), str(partner_id)]))
+
+class TimelineEntry(Document):
+    owner = ReferenceField(User, required=True)  # The user whose feed this entry belongs to
+    post = ReferenceField(Post, required=True)
+    author = ReferenceField(User, required=True)
+    created_at = DateTimeField(required=True)  # Copied from the post so the feed can be range-read
+    
+    meta = {
+        'collection': 'timelines',
+        'indexes': [
+            {'fields': ['owner', 'post'], 'unique': True},
+            ('owner', '-created_at', '-post'),
+            ('owner', 'author')  # Dropping an unfollowed author's posts
+        ]
     }
 
 class Notification(Document):
@@ -81,9 +167,42 @@ class Notification(Document):
     notification_type = StringField(required=True)  # 'like', 'comment', 'follow', 'message'
     post = ReferenceField(Post)  # Optional, for post-related notifications
     is_read = BooleanField(default=False)
-    created_at = DateTimeField(default=datetime.utcnow)
+    created_at = DateTimeField(default=datetime.utcnow)  # Latest activity in the group
+    
+    # Grouping, maintained by notifier.notify; sender is the most recent actor
+    group_key = StringField()  # e.g. 'like:<post_id>', 'follow', 'message:<sender_id>'
+    bucket = DateTimeField()  # Start of the time window the group covers
+    actors = ListField(ReferenceField(User))  # Most recent distinct actors, oldest first
+    actor_count = IntField(default=1)
+    event_count = IntField(default=1)
     
     meta = {
         'collection': 'notifications',
-        'indexes': ['recipient', 'is_read', 'created_at']
+        'indexes': [
+            ('recipient', '-created_at', '-id'),  # Notification pages
+            ('recipient', 'is_read'),  # Mark-read and unread recounts
+            {
+                'fields': ['recipient', 'group_key', 'bucket'],
+                'unique': True,
+                'partialFilterExpression': {'group_key': {'$exists': True}}
+            }
+        ]
+    }
+
+class UnreadCounter(Document):
+    id = ObjectIdField(primary_key=True)  # The user's id
+    notifications = IntField(default=0)  # Unread notification groups
+    messages = IntField(default=0)  # Unread messages across all conversations
+    
+    meta = {
+        'collection': 'unread_counters'
+    }
+
+class UserSuggestions(Document):
+    id = ObjectIdField(primary_key=True)  # The user's id
+    candidates = ListField(DictField())  # {'user', 'score', 'mutual'}, best first; written by suggestions.refresh_suggestions
+    refreshed_at = DateTimeField(default=datetime.utcnow)
+    
+    meta = {
+        'collection': 'user_suggestions'
     }
\ No newline at end of file
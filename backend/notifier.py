@@ -0,0 +1,82 @@
+# notifier.py
+# Grouped notifications: one document per (recipient, activity, time bucket), updated in place
+import calendar
+from datetime import datetime
+from flask import current_app
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from models import Notification
+from hydration import ref_id
+from unread import change_unread
+
+def group_key_for(notification_type, actor_id, post_id=None):
+    """Activities that collapse into one notification share a group key"""
+    if notification_type in ('like', 'comment'):
+        return f"{notification_type}:{post_id}"
+    if notification_type == 'message':
+        # One entry per conversation partner: "Bob sent you 4 messages"
+        return f"message:{actor_id}"
+    return notification_type
+
+def bucket_for(moment, hours):
+    """Start of the fixed time window the moment falls in"""
+    seconds = hours * 3600
+    timestamp = calendar.timegm(moment.utctimetuple())
+    return datetime.utcfromtimestamp(timestamp - timestamp % seconds)
+
+def notify(recipient_id, actor_id, notification_type, post_id=None):
+    """Fold one activity into the recipient's grouped notification
+
+    A new actor is pushed onto the capped actors list and counted; a repeat actor
+    only bumps the event count. Either way the group moves to the top as unread.
+    Returns True when the recipient gained an unread notification.
+    """
+    now = datetime.utcnow()
+    recipient = ref_id(recipient_id)
+    actor = ref_id(actor_id)
+    group = {
+        'recipient': recipient,
+        'group_key': group_key_for(notification_type, actor_id, post_id),
+        'bucket': bucket_for(now, current_app.config['NOTIFICATION_BUCKET_HOURS'])
+    }
+    bump = {
+        '$set': {'sender': actor, 'created_at': now, 'is_read': False},
+        '$inc': {'event_count': 1}
+    }
+    on_insert = {'notification_type': notification_type}
+    if post_id:
+        on_insert['post'] = ref_id(post_id)
+    
+    # New actor for this group (or no group yet): upsert with the actor pushed on
+    new_actor = {
+        '$set': bump['$set'],
+        '$inc': {'event_count': 1, 'actor_count': 1},
+        '$push': {'actors': {'$each': [actor], '$slice': -current_app.config['NOTIFICATION_ACTORS_KEPT']}},
+        '$setOnInsert': on_insert
+    }
+    collection = Notification._get_collection()
+    
+    # Repeat actor (every message after the first in a conversation): one round trip
+    before = collection.find_one_and_update(
+        {**group, 'actors': actor}, bump,
+        projection={'is_read': 1}, return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        # New actor for this group, or no group yet: upsert with the actor pushed on
+        try:
+            before = collection.find_one_and_update(
+                {**group, 'actors': {'$ne': actor}}, new_actor,
+                projection={'is_read': 1}, upsert=True, return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            # A concurrent request created the group or added this actor first
+            before = collection.find_one_and_update(
+                group, bump, projection={'is_read': 1}, return_document=ReturnDocument.BEFORE
+            )
+            if before is None:
+                return False
+    
+    became_unread = before is None or before.get('is_read', False)
+    if became_unread:
+        change_unread(recipient_id, notifications=1)
+    return became_unread
@@ -0,0 +1,57 @@
+# pagination.py
+# Opaque keyset cursors over (created_at, _id) so page fetches don't depend on depth
+import base64
+from datetime import datetime
+from bson import ObjectId
+from flask import request
+from mongoengine.queryset.visitor import Q
+
+MAX_PER_PAGE = 50
+
+def encode_cursor(created_at, object_id):
+    """Encode a (created_at, _id) position as an opaque URL-safe token"""
+    raw = f"{created_at.isoformat()}|{object_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Decode a cursor token, raising ValueError if it is malformed"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        created_at, object_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), ObjectId(object_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def get_per_page(default):
+    """Read per_page from the query string, clamped to MAX_PER_PAGE (non-numeric values fall back to default)"""
+    per_page = request.args.get('per_page', default, type=int)
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+def older_than(cursor, id_field='id'):
+    """Q filter for documents strictly after the cursor in (-created_at, -id) order"""
+    created_at, object_id = decode_cursor(cursor)
+    return Q(created_at__lt=created_at) | Q(**{'created_at': created_at, f'{id_field}__lt': object_id})
+
+def newer_than(cursor, id_field='id'):
+    """Q filter for documents strictly before the cursor in (-created_at, -id) order"""
+    created_at, object_id = decode_cursor(cursor)
+    return Q(created_at__gt=created_at) | Q(**{'created_at': created_at, f'{id_field}__gt': object_id})
+
+def paginate(queryset, cursor, per_page, id_field='id'):
+    """Apply keyset pagination to a queryset, newest first"""
+    if cursor:
+        queryset = queryset.filter(older_than(cursor, id_field))
+    return queryset.order_by('-created_at', f'-{id_field}').limit(per_page)
+
+def paginate_after(queryset, cursor, per_page, id_field='id'):
+    """Apply keyset pagination to a queryset, oldest first, starting after the cursor"""
+    return queryset.filter(newer_than(cursor, id_field)).order_by('created_at', id_field).limit(per_page)
+
+def next_cursor(items, per_page, id_field='id'):
+    """Build the cursor for the page after items, or None on the last page"""
+    if len(items) < per_page:
+        return None
+    last = items[-1]
+    if isinstance(last, dict):
+        return encode_cursor(last['created_at'], last['_id' if id_field == 'id' else id_field])
+    return encode_cursor(last.created_at, getattr(last, id_field).id if id_field != 'id' else last.id)
@@ -0,0 +1,188 @@
+# presence.py
+# Which users have an open socket: user id -> socket ids, in this process or shared through Redis
+import time
+import threading
+from datetime import datetime
+from models import User
+from hydration import ref_id
+
+_backend = None
+_authoritative = False  # False when sockets may live in workers this registry cannot see
+_connections = {}  # sid -> user id, for sockets held by this process
+_lock = threading.Lock()
+
+class MemoryPresence:
+    """Registry for a single worker process"""
+    shared = False
+
+    def __init__(self):
+        self.sids = {}
+        self.lock = threading.Lock()
+
+    def add(self, user_id, sid):
+        """Register one socket; returns True when it is the user's first"""
+        with self.lock:
+            sids = self.sids.setdefault(user_id, set())
+            first = not sids
+            sids.add(sid)
+            return first
+
+    def remove(self, user_id, sid):
+        """Drop one socket; returns True when it was the user's last"""
+        with self.lock:
+            sids = self.sids.get(user_id)
+            if sids is None:
+                return False
+            sids.discard(sid)
+            if sids:
+                return False
+            del self.sids[user_id]
+            return True
+
+    def refresh(self, connections):
+        pass
+
+    def online_among(self, user_ids):
+        return {user_id for user_id in user_ids if user_id in self.sids}
+
+    def online_users(self):
+        return list(self.sids)
+
+class RedisPresence:
+    """Registry shared by every worker
+
+    Each socket is a member of presence:<user_id> scored by its expiry time. Workers
+    keep refreshing their own sockets, so entries left behind by a crashed worker
+    age out after PRESENCE_TTL instead of showing the user online forever.
+    """
+    shared = True
+
+    def __init__(self, url, ttl):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def _key(self, user_id):
+        return f"presence:{user_id}"
+
+    def add(self, user_id, sid):
+        key = self._key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, '-inf', time.time())
+        pipe.zcard(key)
+        pipe.zadd(key, {sid: time.time() + self.ttl})
+        pipe.expire(key, int(self.ttl) + 1)
+        return pipe.execute()[1] == 0
+
+    def remove(self, user_id, sid):
+        key = self._key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.zrem(key, sid)
+        pipe.zremrangebyscore(key, '-inf', time.time())
+        pipe.zcard(key)
+        return pipe.execute()[2] == 0
+
+    def refresh(self, connections):
+        expires_at = time.time() + self.ttl
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, sid in connections:
+            pipe.zadd(self._key(user_id), {sid: expires_at})
+            pipe.expire(self._key(user_id), int(self.ttl) + 1)
+        pipe.execute()
+
+    def online_among(self, user_ids):
+        user_ids = list(user_ids)
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zcount(self._key(user_id), now, '+inf')
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+    def online_users(self):
+        # Not enumerable without a scan; callers filter their own candidates with online_among
+        return None
+
+def init_presence(socketio, config):
+    """Pick the backend from PRESENCE_BACKEND and keep shared entries alive"""
+    global _backend, _authoritative
+    if _backend is not None:
+        return
+    url = config.get('PRESENCE_BACKEND') or 'memory'
+    if url == 'memory':
+        _backend = MemoryPresence()
+    else:
+        _backend = RedisPresence(url, config['PRESENCE_TTL'])
+        socketio.start_background_task(_refresh_loop, socketio, config['PRESENCE_TTL'] / 3)
+
+    # A per-process registry only knows about every socket when there is a single worker
+    _authoritative = _backend.shared or not config.get('SOCKETIO_MESSAGE_QUEUE')
+    if not _authoritative:
+        print("Presence is per process while SOCKETIO_MESSAGE_QUEUE is set; emits will not be filtered")
+
+def _refresh_loop(socketio, interval):
+    while True:
+        socketio.sleep(interval)
+        with _lock:
+            connections = [(user_id, sid) for sid, user_id in _connections.items()]
+        try:
+            _backend.refresh(connections)
+        except Exception as e:
+            print(f"Error refreshing presence: {e}")
+
+def user_connected(user_id, sid):
+    """Register an authenticated socket; records last_seen when it is the user's first"""
+    user_id = str(user_id)
+    with _lock:
+        _connections[sid] = user_id
+    if _backend.add(user_id, sid):
+        User.objects(id=ref_id(user_id)).update_one(set__last_seen=datetime.utcnow())
+
+def user_disconnected(sid):
+    """Forget a socket; records last_seen when the user's last socket closes"""
+    with _lock:
+        user_id = _connections.pop(sid, None)
+    if user_id is None:
+        return
+    if _backend.remove(user_id, sid):
+        User.objects(id=ref_id(user_id)).update_one(set__last_seen=datetime.utcnow())
+
+def online_among(user_ids):
+    """String ids of the users with at least one open socket"""
+    return _backend.online_among({str(user_id) for user_id in user_ids})
+
+def is_online(user_id):
+    return bool(online_among([user_id]))
+
+def presence_of(user_ids):
+    """Online flag and last_seen per user id, with one query for the offline users"""
+    user_ids = {str(user_id) for user_id in user_ids}
+    online = online_among(user_ids)
+    offline = [ref_id(user_id) for user_id in user_ids - online]
+    last_seen = {}
+    if offline:
+        for doc in User.objects(id__in=offline).only('last_seen').as_pymongo():
+            last_seen[str(doc['_id'])] = doc.get('last_seen')
+
+    result = {}
+    for user_id in user_ids:
+        seen = last_seen.get(user_id)
+        result[user_id] = {
+            "online": user_id in online,
+            "last_seen": None if user_id in online or not seen else seen.isoformat()
+        }
+    return result
+
+def reachable_among(user_ids):
+    """Users worth emitting to: the online ones, or all of them when presence cannot tell"""
+    if not _authoritative:
+        return {str(user_id) for user_id in user_ids}
+    return online_among(user_ids)
+
+def is_reachable(user_id):
+    return bool(reachable_among([user_id]))
+
+def online_user_ids():
+    """Every online user id when the registry can list them, otherwise None"""
+    if not _authoritative:
+        return None
+    return _backend.online_users()
@@ -7,9 +7,12 @@ from werkzeug.utils import secure_filename
 import os
 import re
 from datetime import datetime, timedelta
-import base64
-from PIL import Image
-import io
+from media import store_raw, decode_image_data, submit_batch, discard_files, primary_url, rendition_map, parse_streamed_upload, ProcessingBusy
+from werkzeug.exceptions import RequestEntityTooLarge
+from socket_events import emit_profile_picture_processed
+from concurrency import run_blocking
+from user_cache import get_user, invalidate_user
+from card_cache import invalidate_cards
 
 auth = Blueprint('auth', __name__)
 
@@ -26,6 +29,38 @@ def validate_username(username):
     pattern = r'^[a-zA-Z0-9_]{3,30}$'
     return re.match(pattern, username) is not None
 
+def queue_profile_picture(user_id, upload):
+    """Resize an avatar in the background and point the user at it once it exists
+
+    Returns 'processing', or 'ready'/'failed' when it finished before returning (renditions already on disk).
+    """
+    app = current_app._get_current_object()
+    sizes = current_app.config['AVATAR_IMAGE_SIZES']
+    digest = upload[1]
+    outcome = {}
+    
+    def on_complete(errors):
+        with app.app_context():
+            if errors:
+                print(f"Profile picture processing failed for user {user_id}: {errors[0]}")
+                emit_profile_picture_processed(str(user_id), {"status": "failed"})
+                outcome['status'] = 'failed'
+                return
+            
+            profile_picture = primary_url(digest, sizes)
+            User.objects(id=user_id).update_one(set__profile_picture=profile_picture)
+            invalidate_user(user_id)
+            invalidate_cards(user_id)
+            emit_profile_picture_processed(str(user_id), {
+                "status": "ready",
+                "profile_picture": profile_picture,
+                "profile_picture_renditions": rendition_map(digest, sizes)
+            })
+            outcome['status'] = 'ready'
+    
+    submit_batch(current_app.config['UPLOAD_FOLDER'], [upload], sizes, on_complete)
+    return outcome.get('status', 'processing')
+
 @auth.route('/register', methods=['POST'])
 def register():
     try:
@@ -64,7 +99,7 @@ def register():
             return jsonify({"error": "Email already exists"}), 400
         
         # Create user
-        hashed_password = generate_password_hash(password)
+        hashed_password = run_blocking(generate_password_hash, password)
         user = User(
             username=username,
             email=email,
@@ -109,7 +144,7 @@ def login():
         if not user:
             user = User.objects(email=username).first()
         
-        if not user or not check_password_hash(user.password, password):
+        if not user or not run_blocking(check_password_hash, user.password, password):
             return jsonify({"error": "Invalid username/email or password"}), 401
         
         # Create access token
@@ -138,52 +173,56 @@ def login():
 def setup_profile():
     try:
         current_user_id = get_jwt_identity()
-        user = User.objects(id=current_user_id).first()
+        user = get_user(current_user_id)
         
         if not user:
             return jsonify({"error": "User not found"}), 404
         
-        data = request.get_json()
-        
-        if 'profile_picture' in data and data['profile_picture']:
-            # Handle base64 image
+        upload = None
+        if request.mimetype == 'multipart/form-data':
+            # Streamed upload: the picture is spooled straight to disk while it arrives
             try:
-                image_data = data['profile_picture']
-                if image_data.startswith('data:image'):
-                    # Remove data URL prefix
-                    image_data = image_data.split(',')[1]
-                
-                # Decode base64
-                image_bytes = base64.b64decode(image_data)
-                
-                # Process image with Pillow
-                img = Image.open(io.BytesIO(image_bytes))
-                
-                # Convert to RGB if necessary
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # Resize to 400x400
-                img.thumbnail((400, 400), Image.Resampling.LANCZOS)
-                
-                # Save to file
-                filename = f"profile_{user.id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.jpg"
-                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                img.save(filepath, 'JPEG', quality=85)
-                
-                # Update user profile picture
-                user.profile_picture = f"/uploads/{filename}"
-                
-            except Exception as e:
-                return jsonify({"error": "Invalid image format"}), 400
+                data, files = parse_streamed_upload(request.environ, current_app.config, ('profile_picture',))
+            except RequestEntityTooLarge:
+                return jsonify({"error": "Image is too large"}), 413
+            except ValueError:
+                return jsonify({"error": "Invalid upload"}), 400
+            
+            pictures = files.get('profile_picture', [])
+            discard_files(raw_path for raw_path, _ in pictures[1:])
+            upload = pictures[0] if pictures else None
+        else:
+            data = request.get_json()
         
         if 'bio' in data:
             bio = data['bio'].strip()
             if len(bio) > 150:
+                if upload:
+                    discard_files([upload[0]])
                 return jsonify({"error": "Bio must be 150 characters or less"}), 400
             user.bio = bio
         
+        if upload is None and data.get('profile_picture'):
+            try:
+                upload = store_raw(current_app.config['RAW_UPLOAD_FOLDER'], decode_image_data(data['profile_picture']))
+            except Exception as e:
+                return jsonify({"error": "Invalid image format"}), 400
+        
+        avatar_status = None
+        if upload:
+            # The worker pool resizes the raw upload and swaps it in when done
+            try:
+                avatar_status = queue_profile_picture(user.id, upload)
+            except ProcessingBusy:
+                discard_files([upload[0]])
+                return jsonify({"error": "Image processing is busy, please try again"}), 503
+            if avatar_status == 'ready':
+                # Known content completes right away, so report the new picture rather than the old one
+                user.profile_picture = primary_url(upload[1], current_app.config['AVATAR_IMAGE_SIZES'])
+        
         user.save()
+        invalidate_user(user.id)
+        invalidate_cards(user.id)
         
         return jsonify({
             "message": "Profile updated successfully",
@@ -193,7 +232,8 @@ def setup_profile():
                 "email": user.email,
                 "profile_picture": user.profile_picture,
                 "bio": user.bio
-            }
+            },
+            "profile_picture_status": avatar_status
         }), 200
         
     except Exception as e:
@@ -204,7 +244,7 @@ def setup_profile():
 def get_profile():
     try:
         current_user_id = get_jwt_identity()
-        user = User.objects(id=current_user_id).first()
+        user = get_user(current_user_id)
         
         if not user:
             return jsonify({"error": "User not found"}), 404
@@ -216,8 +256,8 @@ def get_profile():
                 "email": user.email,
                 "profile_picture": user.profile_picture,
                 "bio": user.bio,
-                "followers_count": len(user.followers),
-                "following_count": len(user.following),
+                "followers_count": user.followers_count,
+                "following_count": user.following_count,
                 "created_at": user.created_at.isoformat()
             }
         }), 200
@@ -1,72 +1,78 @@
 # routes/messages.py
 from flask import Blueprint, request, jsonify
-from models import Message, User, Notification
+from models import Message, Conversation
+from notifier import notify
+from user_cache import get_user
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime
 from socket_events import emit_new_message
+from hydration import load_user_cards
+from serializers import MESSAGE_FIELDS, user_card, serialize_message
+from presence import presence_of
+from unread import get_unread_counts, change_unread
+from pagination import paginate, paginate_after, encode_cursor, get_per_page
 
 messages = Blueprint('messages', __name__)
 
+def mark_conversation_read(current_user, partner):
+    """Mark the partner's messages as read and take exactly those off the user's unread counts"""
+    marked = Message.objects(
+        sender=partner,
+        receiver=current_user,
+        is_read=False
+    ).update(is_read=True)
+    
+    if not marked:
+        return
+    
+    # Decrement rather than zero, so a message that arrives between the two writes stays counted
+    Conversation.objects(
+        conversation_id=Conversation.key_for(current_user.id, partner.id)
+    ).update_one(**{f"dec__unread_counts__{current_user.id}": marked})
+    change_unread(current_user.id, messages=-marked)
+
 @messages.route('/conversations', methods=['GET'])
 @jwt_required()
 def get_conversations():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
         
-        # Get all messages where current user is sender or receiver
-        sent_messages = Message.objects(sender=current_user)
-        received_messages = Message.objects(receiver=current_user)
-        
-        # Get unique conversation partners
-        conversation_partners = set()
-        
-        for msg in sent_messages:
-            conversation_partners.add(str(msg.receiver.id))
+        # One indexed read of the user's conversation summaries, most recent first
+        summaries = list(Conversation.objects(participants=current_user.id).order_by('-last_message_at').as_pymongo())
         
-        for msg in received_messages:
-            conversation_partners.add(str(msg.sender.id))
+        partner_ids = []
+        for summary in summaries:
+            partner_ids.extend(p for p in summary['participants'] if str(p) != str(current_user_id))
+        partners = load_user_cards(partner_ids)
+        presence = presence_of(partner_ids)
         
         conversations = []
-        for partner_id in conversation_partners:
-            partner = User.objects(id=partner_id).first()
+        for summary in summaries:
+            partner_id = next((p for p in summary['participants'] if str(p) != str(current_user_id)), None)
+            partner = partners.get(str(partner_id))
             if not partner:
                 continue
             
-            # Get last message in this conversation
-            last_message = Message.objects(
-                sender__in=[current_user, partner],
-                receiver__in=[current_user, partner]
-            ).order_by('-created_at').first()
-            
-            # Get unread count
-            unread_count = Message.objects(
-                sender=partner,
-                receiver=current_user,
-                is_read=False
-            ).count()
-            
             conversations.append({
-                "partner": {
-                    "id": str(partner.id),
-                    "username": partner.username,
-                    "profile_picture": partner.profile_picture
-                },
+                "partner": partner,
                 "last_message": {
-                    "content": last_message.content,
-                    "created_at": last_message.created_at.isoformat(),
-                    "is_from_me": str(last_message.sender.id) == str(current_user_id)
+                    "content": summary.get('last_message_content', ''),
+                    "created_at": summary['last_message_at'].isoformat(),
+                    "is_from_me": str(summary.get('last_sender')) == str(current_user_id)
                 },
-                "unread_count": unread_count
+                "unread_count": summary.get('unread_counts', {}).get(str(current_user_id), 0),
+                "is_online": presence[str(partner_id)]["online"],
+                "last_seen": presence[str(partner_id)]["last_seen"]
             })
         
-        # Sort by last message time
-        conversations.sort(key=lambda x: x['last_message']['created_at'], reverse=True)
-        
-        return jsonify({"conversations": conversations}), 200
+        return jsonify({
+            "conversations": conversations,
+            "unread_messages": get_unread_counts(current_user.id)['messages']
+        }), 200
         
     except Exception as e:
         return jsonify({"error": "Failed to get conversations"}), 500
@@ -76,18 +82,14 @@ def get_conversations():
 def mark_messages_as_read(partner_id):
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
-        partner = User.objects(id=partner_id).first()
+        current_user = get_user(current_user_id)
+        partner = get_user(partner_id)
         
         if not current_user or not partner:
             return jsonify({"error": "User not found"}), 404
         
         # Mark messages as read
-        Message.objects(
-            sender=partner,
-            receiver=current_user,
-            is_read=False
-        ).update(is_read=True)
+        mark_conversation_read(current_user, partner)
         
         return jsonify({"message": "Messages marked as read"}), 200
         
@@ -99,42 +101,48 @@ def mark_messages_as_read(partner_id):
 def get_messages(partner_id):
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
-        partner = User.objects(id=partner_id).first()
+        current_user = get_user(current_user_id)
+        partner = get_user(partner_id)
         
         if not current_user or not partner:
             return jsonify({"error": "User not found"}), 404
         
-        # Get messages between current user and partner
-        messages = Message.objects(
-            sender__in=[current_user, partner],
-            receiver__in=[current_user, partner]
-        ).order_by('created_at')
-        
-        # Mark messages as read
-        Message.objects(
-            sender=partner,
-            receiver=current_user,
-            is_read=False
-        ).update(is_read=True)
-        
-        messages_data = []
-        for msg in messages:
-            messages_data.append({
-                "id": str(msg.id),
-                "content": msg.content,
-                "created_at": msg.created_at.isoformat(),
-                "is_from_me": str(msg.sender.id) == str(current_user_id),
-                "is_read": msg.is_read
-            })
+        conversation_id = Conversation.key_for(current_user.id, partner.id)
+        before = request.args.get('before')
+        after = request.args.get('after')
+        per_page = get_per_page(50)
+        
+        # Latest page (or an older page with 'before'), or only the deltas since 'after'
+        try:
+            history = Message.objects(conversation_id=conversation_id).only(*MESSAGE_FIELDS)
+            if after:
+                messages = list(paginate_after(history, after, per_page).as_pymongo())
+            else:
+                messages = list(paginate(history, before, per_page).as_pymongo())
+                messages.reverse()
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        
+        # Only touch read state when the latest messages are being viewed and something is unread
+        if not before:
+            summary = Conversation.objects(conversation_id=conversation_id).only('unread_counts').first()
+            if summary and summary.unread_counts.get(str(current_user.id)):
+                mark_conversation_read(current_user, partner)
+        
+        messages_data = [serialize_message(msg, current_user_id) for msg in messages]
+        
+        # Cursors for loading older history and for fetching deltas after a reconnect
+        before_cursor = None
+        if messages and not after and len(messages) == per_page:
+            before_cursor = encode_cursor(messages[0]['created_at'], messages[0]['_id'])
+        after_cursor = encode_cursor(messages[-1]['created_at'], messages[-1]['_id']) if messages else after
         
         return jsonify({
             "messages": messages_data,
-            "partner": {
-                "id": str(partner.id),
-                "username": partner.username,
-                "profile_picture": partner.profile_picture
-            }
+            "partner": user_card(partner),
+            "partner_presence": presence_of([partner.id])[str(partner.id)],
+            "before_cursor": before_cursor,
+            "after_cursor": after_cursor
         }), 200
         
     except Exception as e:
@@ -145,8 +153,8 @@ def get_messages(partner_id):
 def send_message(partner_id):
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
-        partner = User.objects(id=partner_id).first()
+        current_user = get_user(current_user_id)
+        partner = get_user(partner_id)
         
         if not current_user or not partner:
             return jsonify({"error": "User not found"}), 404
@@ -168,13 +176,22 @@ def send_message(partner_id):
         )
         message.save()
         
-        # Create notification
-        notification = Notification(
-            recipient=partner,
-            sender=current_user,
-            notification_type='message'
+        # Keep the conversation summary current for both inboxes
+        Conversation.objects(
+            conversation_id=Conversation.key_for(current_user.id, partner.id)
+        ).update_one(
+            upsert=True,
+            set__participants=[current_user.id, partner.id],
+            set__last_message_content=message.content,
+            set__last_sender=current_user.id,
+            set__last_message_at=message.created_at,
+            **{f"inc__unread_counts__{partner.id}": 1}
         )
-        notification.save()
+        
+        change_unread(partner.id, messages=1)
+        
+        # Create notification
+        notify(partner.id, current_user.id, 'message')
         
         # Emit real-time message to both sender and receiver
         emit_new_message(str(current_user_id), str(partner_id), {
@@ -1,8 +1,13 @@
 # routes/notifications.py
-from flask import Blueprint, request, jsonify
-from models import Notification, User
+from flask import Blueprint, request, jsonify, current_app
+from models import Notification
+from user_cache import get_user
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime
+from pagination import paginate, next_cursor, get_per_page
+from hydration import hydrate_notifications
+from serializers import NOTIFICATION_FIELDS
+from unread import get_unread_counts, change_unread
 
 notifications = Blueprint('notifications', __name__)
 
@@ -11,48 +16,29 @@ notifications = Blueprint('notifications', __name__)
 def get_notifications():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
         
-        # Get notifications with pagination
-        page = int(request.args.get('page', 1))
-        per_page = int(request.args.get('per_page', 20))
+        # Get notifications with keyset pagination
+        before = request.args.get('before')
+        per_page = get_per_page(20)
         
-        notifications = Notification.objects(recipient=current_user).order_by('-created_at').skip((page - 1) * per_page).limit(per_page)
+        try:
+            notifications = list(paginate(
+                Notification.objects(recipient=current_user), before, per_page
+            ).only(*NOTIFICATION_FIELDS).as_pymongo())
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
         
-        notifications_data = []
-        for notification in notifications:
-            notification_data = {
-                "id": str(notification.id),
-                "type": notification.notification_type,
-                "created_at": notification.created_at.isoformat(),
-                "is_read": notification.is_read,
-                "sender": {
-                    "id": str(notification.sender.id),
-                    "username": notification.sender.username,
-                    "profile_picture": notification.sender.profile_picture
-                }
-            }
-            
-            # Add post info if available
-            if notification.post:
-                notification_data["post"] = {
-                    "id": str(notification.post.id),
-                    "images": notification.post.images[:1] if notification.post.images else []
-                }
-            
-            notifications_data.append(notification_data)
-        
-        # Get unread count
-        unread_count = Notification.objects(recipient=current_user, is_read=False).count()
+        notifications_data = hydrate_notifications(notifications, current_app.config['NOTIFICATION_ACTORS_SHOWN'])
         
         return jsonify({
             "notifications": notifications_data,
-            "unread_count": unread_count,
-            "page": page,
-            "per_page": per_page
+            "unread_count": get_unread_counts(current_user.id)['notifications'],
+            "per_page": per_page,
+            "next_cursor": next_cursor(notifications, per_page)
         }), 200
         
     except Exception as e:
@@ -63,7 +49,7 @@ def get_notifications():
 def mark_notifications_read():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
@@ -72,14 +58,17 @@ def mark_notifications_read():
         notification_ids = data.get('notification_ids', [])
         
         if notification_ids:
-            # Mark specific notifications as read
-            Notification.objects(
+            # Mark specific notifications as read; only the ones that were unread move the counter
+            marked = Notification.objects(
                 id__in=notification_ids,
-                recipient=current_user
+                recipient=current_user,
+                is_read=False
             ).update(is_read=True)
+            change_unread(current_user.id, notifications=-marked)
         else:
-            # Mark all notifications as read
-            Notification.objects(recipient=current_user).update(is_read=True)
+            # Mark all notifications as read; subtract what was marked, so one created meanwhile stays counted
+            marked = Notification.objects(recipient=current_user, is_read=False).update(is_read=True)
+            change_unread(current_user.id, notifications=-marked)
         
         return jsonify({"message": "Notifications marked as read"}), 200
         
@@ -91,14 +80,17 @@ def mark_notifications_read():
 def get_unread_count():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
         
-        unread_count = Notification.objects(recipient=current_user, is_read=False).count()
+        counts = get_unread_counts(current_user.id)
         
-        return jsonify({"unread_count": unread_count}), 200
+        return jsonify({
+            "unread_count": counts['notifications'],
+            "unread_messages": counts['messages']
+        }), 200
         
     except Exception as e:
         return jsonify({"error": "Failed to get unread count"}), 500 
\ No newline at end of file
@@ -1,128 +1,149 @@
 # routes/posts.py
 from flask import Blueprint, request, jsonify, current_app
-from models import Post, User, Comment, Like, Notification
+from models import User, Post, Comment, Like
+from notifier import notify
+from user_cache import get_user, invalidate_user
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from mongoengine.errors import NotUniqueError
 from datetime import datetime
-from socket_events import emit_new_like, emit_new_comment
-import os
-import base64
-from PIL import Image
-import io
+from bson import ObjectId
+from socket_events import emit_new_like, emit_new_comment, emit_post_processed
+from timeline import fan_out_post, get_timeline_page
+from pagination import paginate, paginate_after, next_cursor, encode_cursor, get_per_page
+from hydration import hydrate_posts, load_user_cards
+from serializers import COMMENT_FIELDS, user_card, serialize_comment, post_renditions
+from media import store_raw, decode_image_data, submit_batch, discard_files, primary_url, parse_streamed_upload, ProcessingBusy
+from werkzeug.exceptions import RequestEntityTooLarge
 
 posts = Blueprint('posts', __name__)
 
-def save_image(image_data, user_id, post_id, index):
-    try:
-        print(f"DEBUG: save_image called with user_id={user_id}, post_id={post_id}, index={index}")
-        
-        if image_data.startswith('data:image'):
-            image_data = image_data.split(',')[1]
-        
-        print(f"DEBUG: Decoding base64 image data...")
-        image_bytes = base64.b64decode(image_data)
-        print(f"DEBUG: Image decoded, size: {len(image_bytes)} bytes")
-        
-        img = Image.open(io.BytesIO(image_bytes))
-        print(f"DEBUG: Image opened, format: {img.format}, mode: {img.mode}, size: {img.size}")
-        
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-            print(f"DEBUG: Image converted to RGB")
-        
-        # Resize image while maintaining aspect ratio
-        max_size = (1080, 1080)
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        print(f"DEBUG: Image resized to {img.size}")
-        
-        filename = f"post_{user_id}_{post_id}_{index}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.jpg"
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        print(f"DEBUG: Saving image to {filepath}")
-        
-        img.save(filepath, 'JPEG', quality=85)
-        print(f"DEBUG: Image saved successfully")
-        
-        return f"/uploads/{filename}"
-    except Exception as e:
-        print(f"DEBUG: Error in save_image: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise e
+def queue_post_images(post, uploads):
+    """Render a post's images in the background and publish the post once they are ready"""
+    app = current_app._get_current_object()
+    post_id = post.id
+    author_id = post.author.id
+    sizes = current_app.config['POST_IMAGE_SIZES']
+    
+    def on_complete(errors):
+        with app.app_context():
+            if errors:
+                print(f"DEBUG: Image processing failed for post {post_id}: {errors[0]}")
+                Post.objects(id=post_id).update_one(set__status='failed')
+                emit_post_processed(str(author_id), {"id": str(post_id), "status": "failed"})
+                return
+            
+            # Only the transition out of processing publishes the post and counts it
+            ready_post = Post.objects(id=post_id, status='processing').modify(new=True, set__status='ready')
+            if not ready_post:
+                return
+            User.objects(id=author_id).update_one(inc__posts_count=1)
+            invalidate_user(author_id)
+            
+            # Push the post into followers' feed timelines
+            try:
+                fan_out_post(ready_post)
+            except Exception as e:
+                print(f"DEBUG: Error fanning out post {post_id}: {str(e)}")
+            
+            emit_post_processed(str(author_id), {
+                "id": str(post_id),
+                "status": "ready",
+                "images": ready_post.images,
+                "image_renditions": post_renditions(ready_post.image_hashes, sizes)
+            })
+    
+    submit_batch(current_app.config['UPLOAD_FOLDER'], uploads, sizes, on_complete)
 
 @posts.route('/create', methods=['POST'])
 @jwt_required()
 def create_post():
     try:
         current_user_id = get_jwt_identity()
-        user = User.objects(id=current_user_id).first()
+        user = get_user(current_user_id)
         
         if not user:
             return jsonify({"error": "User not found"}), 404
         
-        data = request.get_json()
-        print(f"DEBUG: Received data: {data}")
-        
-        if not data.get('images') or len(data['images']) == 0:
+        if request.mimetype == 'multipart/form-data':
+            # Streamed upload: each image part is spooled straight to disk while it arrives
+            try:
+                form, files = parse_streamed_upload(request.environ, current_app.config, ('images',))
+            except RequestEntityTooLarge:
+                return jsonify({"error": "Image is too large"}), 413
+            except ValueError:
+                return jsonify({"error": "Invalid upload"}), 400
+            
+            uploads = files.get('images', [])
+            caption = form.get('caption', '').strip()
+            location = form.get('location', '').strip()
+        else:
+            data = request.get_json()
+            
+            if not data.get('images') or len(data['images']) == 0:
+                return jsonify({"error": "At least one image is required"}), 400
+            
+            if len(data['images']) > 10:
+                return jsonify({"error": "Maximum 10 images allowed"}), 400
+            
+            caption = data.get('caption', '').strip()
+            location = data.get('location', '').strip()
+            
+            # Persist the raw bytes only; decoding and resizing happen in the worker pool
+            uploads = []
+            for i, image_data in enumerate(data['images']):
+                try:
+                    uploads.append(store_raw(current_app.config['RAW_UPLOAD_FOLDER'], decode_image_data(image_data)))
+                except Exception as e:
+                    print(f"DEBUG: Error storing image {i+1}: {str(e)}")
+                    discard_files(raw_path for raw_path, _ in uploads)
+                    return jsonify({"error": f"Failed to save image {i+1}: {str(e)}"}), 400
+        
+        if not uploads:
             return jsonify({"error": "At least one image is required"}), 400
         
-        if len(data['images']) > 10:
+        if len(uploads) > 10:
+            discard_files(raw_path for raw_path, _ in uploads)
             return jsonify({"error": "Maximum 10 images allowed"}), 400
         
-        caption = data.get('caption', '').strip()
-        location = data.get('location', '').strip()
+        print(f"DEBUG: Stored {len(uploads)} raw images for user {user.id}")
         
-        print(f"DEBUG: Processing images for user {user.id}")
+        # Renditions are named by content hash, so their URLs are known before they exist
+        sizes = current_app.config['POST_IMAGE_SIZES']
+        image_hashes = [digest for _, digest in uploads]
         
-        # Generate a temporary post ID for image naming
-        temp_post_id = str(datetime.utcnow().timestamp())
-        
-        # Save images first
-        image_urls = []
-        for i, image_data in enumerate(data['images']):
-            try:
-                print(f"DEBUG: Processing image {i+1}")
-                image_url = save_image(image_data, user.id, temp_post_id, i)
-                image_urls.append(image_url)
-                print(f"DEBUG: Image {i+1} saved as {image_url}")
-            except Exception as e:
-                print(f"DEBUG: Error saving image {i+1}: {str(e)}")
-                # Clean up any saved images if one fails
-                for saved_url in image_urls:
-                    try:
-                        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], saved_url.split('/')[-1])
-                        if os.path.exists(filepath):
-                            os.remove(filepath)
-                    except:
-                        pass
-                return jsonify({"error": f"Failed to save image {i+1}: {str(e)}"}), 500
-        
-        print(f"DEBUG: All images processed successfully, creating post")
-        
-        # Create post with image URLs already populated
+        # Create post with its final image URLs; it stays hidden until processing finishes
         post = Post(
             author=user,
-            images=image_urls,
+            images=[primary_url(digest, sizes) for digest in image_hashes],
+            image_hashes=image_hashes,
             caption=caption,
-            location=location
+            location=location,
+            status='processing'
         )
         post.save()
         
-        print(f"DEBUG: Post created successfully with ID {post.id}")
+        try:
+            queue_post_images(post, uploads)
+        except ProcessingBusy:
+            post.delete()
+            discard_files(raw_path for raw_path, _ in uploads)
+            return jsonify({"error": "Image processing is busy, please try again"}), 503
+        
+        print(f"DEBUG: Post {post.id} created, images queued for processing")
         
         return jsonify({
             "message": "Post created successfully",
             "post": {
                 "id": str(post.id),
                 "images": post.images,
+                "image_renditions": post_renditions(post.image_hashes, sizes),
                 "caption": post.caption,
                 "location": post.location,
+                "status": post.status,
                 "created_at": post.created_at.isoformat(),
-                "author": {
-                    "id": str(user.id),
-                    "username": user.username,
-                    "profile_picture": user.profile_picture
-                }
+                "author": user_card(user)
             }
-        }), 201
+        }), 202
         
     except Exception as e:
         print(f"DEBUG: Unexpected error in create_post: {str(e)}")
@@ -135,65 +156,32 @@ def create_post():
 def get_feed():
     try:
         current_user_id = get_jwt_identity()
-        user = User.objects(id=current_user_id).first()
+        user = get_user(current_user_id)
         
         if not user:
             return jsonify({"error": "User not found"}), 404
         
-        # Get posts from users that the current user follows, plus their own posts
-        following_ids = [str(following.id) for following in user.following]
-        following_ids.append(str(user.id))
+        # Get posts with keyset pagination
+        before = request.args.get('before')
+        per_page = get_per_page(10)
         
-        # Get posts with pagination
-        page = int(request.args.get('page', 1))
-        per_page = int(request.args.get('per_page', 10))
+        # Read the page from the user's materialized timeline
+        try:
+            page = get_timeline_page(user.id, before, per_page)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
         
-        posts = Post.objects(author__in=following_ids).order_by('-created_at').skip((page - 1) * per_page).limit(per_page)
+        post_ids = [post_id for post_id, _ in page]
+        feed_posts = hydrate_posts(post_ids, user.id)
         
-        feed_posts = []
-        for post in posts:
-            # Check if current user liked this post
-            is_liked = str(user.id) in [str(like_user.id) for like_user in post.likes]
-            
-            # Get comments count
-            comments_count = len(post.comments)
-            
-            # Get first few comments
-            recent_comments = Comment.objects(post=post).order_by('-created_at').limit(3)
-            comments_data = []
-            for comment in recent_comments:
-                comments_data.append({
-                    "id": str(comment.id),
-                    "content": comment.content,
-                    "created_at": comment.created_at.isoformat(),
-                    "author": {
-                        "id": str(comment.author.id),
-                        "username": comment.author.username,
-                        "profile_picture": comment.author.profile_picture
-                    }
-                })
-            
-            feed_posts.append({
-                "id": str(post.id),
-                "images": post.images,
-                "caption": post.caption,
-                "location": post.location,
-                "created_at": post.created_at.isoformat(),
-                "likes_count": len(post.likes),
-                "comments_count": comments_count,
-                "is_liked": is_liked,
-                "comments": comments_data,
-                "author": {
-                    "id": str(post.author.id),
-                    "username": post.author.username,
-                    "profile_picture": post.author.profile_picture
-                }
-            })
+        cursor = None
+        if len(page) == per_page:
+            cursor = encode_cursor(page[-1][1], page[-1][0])
         
         return jsonify({
             "posts": feed_posts,
-            "page": page,
-            "per_page": per_page
+            "per_page": per_page,
+            "next_cursor": cursor
         }), 200
         
     except Exception as e:
@@ -204,90 +192,129 @@ def get_feed():
 def like_post(post_id):
     try:
         current_user_id = get_jwt_identity()
-        user = User.objects(id=current_user_id).first()
-        post = Post.objects(id=post_id).first()
+        user = get_user(current_user_id)
+        post = Post.objects(id=post_id).only('author', 'likes_count').first()
         
         if not user or not post:
             return jsonify({"error": "User or post not found"}), 404
         
-        # Check if already liked
-        if str(user.id) in [str(like_user.id) for like_user in post.likes]:
-            # Unlike
-            post.likes = [like_user for like_user in post.likes if str(like_user.id) != str(user.id)]
-            post.save()
-            
-            return jsonify({
-                "message": "Post unliked",
-                "likes_count": len(post.likes),
-                "is_liked": False
-            }), 200
-        else:
-            # Like
-            post.likes.append(user)
-            post.save()
-            
-            # Create notification if not liking own post
-            if str(post.author.id) != str(user.id):
-                notification = Notification(
-                    recipient=post.author,
-                    sender=user,
-                    notification_type='like',
-                    post=post
-                )
-                notification.save()
+        # Clients may send the desired state to make retries idempotent; otherwise toggle
+        data = request.get_json(silent=True) or {}
+        desired = data.get('liked')
+        
+        if desired is not True:
+            # Unlike: only the request that actually removes the Like decrements the counter
+            removed = Like.objects(user=user, post=post).delete()
+            if removed or desired is False:
+                if removed:
+                    post = Post.objects(id=post.id).modify(new=True, dec__likes_count=1)
                 
-                # Emit real-time like notification
-                emit_new_like(str(post_id), str(current_user_id), str(post.author.id))
-            
+                return jsonify({
+                    "message": "Post unliked",
+                    "likes_count": post.likes_count,
+                    "is_liked": False
+                }), 200
+        
+        # Like: the unique (user, post) index makes concurrent likes count once
+        try:
+            Like(user=user, post=post).save(force_insert=True)
+        except NotUniqueError:
             return jsonify({
                 "message": "Post liked",
-                "likes_count": len(post.likes),
+                "likes_count": post.likes_count,
                 "is_liked": True
             }), 200
+        
+        post = Post.objects(id=post.id).modify(new=True, inc__likes_count=1)
+        
+        # Create notification if not liking own post
+        if str(post.author.id) != str(user.id):
+            notify(post.author.id, user.id, 'like', post.id)
+            
+            # Emit real-time like notification
+            emit_new_like(str(post_id), str(current_user_id), str(post.author.id))
+        
+        return jsonify({
+            "message": "Post liked",
+            "likes_count": post.likes_count,
+            "is_liked": True
+        }), 200
             
     except Exception as e:
         return jsonify({"error": "Failed to like/unlike post"}), 500
 
+def comments_page(comments, page_cursor, per_page, oldest_first=False):
+    """Serialize one keyset page of comments; raises ValueError for a bad cursor"""
+    comments = comments.only(*COMMENT_FIELDS)
+    if oldest_first and page_cursor:
+        page = paginate_after(comments, page_cursor, per_page)
+    elif oldest_first:
+        page = comments.order_by('created_at', 'id').limit(per_page)
+    else:
+        page = paginate(comments, page_cursor, per_page)
+    page = list(page.as_pymongo())
+    cards = load_user_cards(comment['author'] for comment in page)
+    return [serialize_comment(comment, cards) for comment in page], next_cursor(page, per_page)
+
 @posts.route('/<post_id>/comments', methods=['GET'])
 @jwt_required()
 def get_post_comments(post_id):
     try:
-        post = Post.objects(id=post_id).first()
+        post = Post.objects(id=post_id).only('comments_count').first()
         
         if not post:
             return jsonify({"error": "Post not found"}), 404
         
-        comments = Comment.objects(post=post).order_by('-created_at')
-        
-        comments_data = []
-        for comment in comments:
-            comments_data.append({
-                "id": str(comment.id),
-                "content": comment.content,
-                "created_at": comment.created_at.isoformat(),
-                "likes_count": len(comment.likes),
-                "author": {
-                    "id": str(comment.author.id),
-                    "username": comment.author.username,
-                    "profile_picture": comment.author.profile_picture
-                }
-            })
+        # Top-level comments, newest first; replies are fetched per thread
+        try:
+            comments_data, cursor = comments_page(
+                Comment.objects(post=post.id, parent=None), request.args.get('before'), get_per_page(20)
+            )
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
         
         return jsonify({
             "comments": comments_data,
-            "total": len(comments_data)
+            "total": post.comments_count,
+            "next_cursor": cursor
         }), 200
         
     except Exception as e:
         return jsonify({"error": "Failed to get comments"}), 500
 
+@posts.route('/<post_id>/comments/<comment_id>/replies', methods=['GET'])
+@jwt_required()
+def get_comment_replies(post_id, comment_id):
+    try:
+        parent = Comment.objects(id=comment_id, post=post_id).only('replies_count').first()
+        
+        if not parent:
+            return jsonify({"error": "Comment not found"}), 404
+        
+        # Direct replies, oldest first so a thread reads top to bottom
+        try:
+            replies_data, cursor = comments_page(
+                Comment.objects(parent=parent.id), request.args.get('after'), get_per_page(20), oldest_first=True
+            )
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        
+        return jsonify({
+            "replies": replies_data,
+            "total": parent.replies_count,
+            "next_cursor": cursor
+        }), 200
+        
+    except Exception as e:
+        return jsonify({"error": "Failed to get replies"}), 500
+
 @posts.route('/<post_id>/comments', methods=['POST'])
 @jwt_required()
 def add_comment(post_id):
     try:
         current_user_id = get_jwt_identity()
-        user = User.objects(id=current_user_id).first()
-        post = Post.objects(id=post_id).first()
+        user = get_user(current_user_id)
+        post = Post.objects(id=post_id).only('author').first()
         
         if not user or not post:
             return jsonify({"error": "User or post not found"}), 404
@@ -301,52 +328,47 @@ def add_comment(post_id):
         if len(content) > 1000:
             return jsonify({"error": "Comment too long"}), 400
         
+        # Replies name the comment they answer; past COMMENT_MAX_DEPTH they join that comment's thread
+        parent_id = None
+        depth = 0
+        if data.get('parent_id'):
+            if not ObjectId.is_valid(data['parent_id']):
+                return jsonify({"error": "Invalid parent comment id"}), 400
+            parent = Comment.objects(id=data['parent_id'], post=post.id).only('parent', 'depth').as_pymongo().first()
+            if not parent:
+                return jsonify({"error": "Parent comment not found"}), 404
+            max_depth = current_app.config['COMMENT_MAX_DEPTH']
+            if parent.get('depth', 0) >= max_depth:
+                parent_id, depth = parent['parent'], max_depth
+            else:
+                parent_id, depth = parent['_id'], parent.get('depth', 0) + 1
+        
         comment = Comment(
             author=user,
             post=post,
-            content=content
+            content=content,
+            parent=parent_id,
+            depth=depth
         )
         comment.save()
         
-        # Add comment to post
-        post.comments.append(comment)
-        post.save()
+        # Bump the counters without rewriting the post or parent documents
+        Post.objects(id=post.id).update_one(inc__comments_count=1)
+        if parent_id:
+            Comment.objects(id=parent_id).update_one(inc__replies_count=1)
+        
+        comment_data = serialize_comment(comment.to_mongo(), {str(user.id): user_card(user)})
         
         # Create notification if not commenting on own post
         if str(post.author.id) != str(user.id):
-            notification = Notification(
-                recipient=post.author,
-                sender=user,
-                notification_type='comment',
-                post=post
-            )
-            notification.save()
+            notify(post.author.id, user.id, 'comment', post.id)
             
             # Emit real-time comment notification
-            comment_data = {
-                "id": str(comment.id),
-                "content": comment.content,
-                "created_at": comment.created_at.isoformat(),
-                "author": {
-                    "id": str(user.id),
-                    "username": user.username,
-                    "profile_picture": user.profile_picture
-                }
-            }
             emit_new_comment(str(post_id), comment_data)
         
         return jsonify({
             "message": "Comment added successfully",
-            "comment": {
-                "id": str(comment.id),
-                "content": comment.content,
-                "created_at": comment.created_at.isoformat(),
-                "author": {
-                    "id": str(user.id),
-                    "username": user.username,
-                    "profile_picture": user.profile_picture
-                }
-            }
+            "comment": comment_data
         }), 201
         
     except Exception as e:
@@ -1,9 +1,21 @@
 # routes/users.py
 from flask import Blueprint, request, jsonify, current_app
-from models import User, Post, Notification
+from models import User, Post, Follow
+from notifier import notify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime
+from bson import ObjectId
 from socket_events import emit_new_follow, emit_profile_update
+from timeline import backfill_timeline, remove_from_timeline, UNPUBLISHED
+from pagination import paginate, next_cursor, get_per_page
+from serializers import USER_SUMMARY_FIELDS, GRID_POST_FIELDS, user_summary, grid_post
+from media import remove_upload
+from presence import presence_of
+from search import search_users as find_users
+from suggestions import get_suggestions, drop_suggestion
+from user_cache import get_user, invalidate_user
+from card_cache import invalidate_cards, card_cache_stats
+from follows import follow, unfollow, is_following as is_following_user
 
 users = Blueprint('users', __name__)
 
@@ -12,7 +24,7 @@ users = Blueprint('users', __name__)
 def search_users():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
@@ -22,64 +34,83 @@ def search_users():
         if not query:
             return jsonify({"users": []}), 200
         
-        # Search users by username (case insensitive)
-        users = User.objects(username__icontains=query).limit(20)
-        
-        users_data = []
-        for user in users:
-            # Don't include current user in search results
-            if str(user.id) == str(current_user_id):
-                continue
-                
-            # Check if current user is following this user
-            is_following = str(user.id) in [str(following.id) for following in current_user.following]
-            
-            users_data.append({
-                "id": str(user.id),
-                "username": user.username,
-                "profile_picture": user.profile_picture,
-                "bio": user.bio,
-                "is_following": is_following,
-                "followers_count": len(user.followers),
-                "following_count": len(user.following)
-            })
+        # Anchored prefix match on the indexed lowercase username, ranked for this viewer
+        users_data = find_users(current_user.id, query)
         
         return jsonify({"users": users_data}), 200
         
     except Exception as e:
         return jsonify({"error": "Search failed"}), 500
 
+def follow_list_page(edges, user_field, before, per_page):
+    """Serialize one page of follow edges as the users on the other end"""
+    edges = list(paginate(edges, before, per_page).only(user_field, 'created_at').as_pymongo())
+    user_ids = [edge[user_field] for edge in edges]
+    users = {user['_id']: user for user in User.objects(id__in=user_ids).only(*USER_SUMMARY_FIELDS).as_pymongo()}
+    users_data = [user_summary(users[user_id]) for user_id in user_ids if user_id in users]
+    return users_data, next_cursor(edges, per_page)
+
 @users.route('/following', methods=['GET'])
 @jwt_required()
 def get_following():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
         
-        following_data = []
-        for user in current_user.following:
-            following_data.append({
-                "id": str(user.id),
-                "username": user.username,
-                "profile_picture": user.profile_picture,
-                "bio": user.bio
-            })
+        try:
+            following_data, cursor = follow_list_page(
+                Follow.objects(follower=current_user.id), 'followee', request.args.get('before'), get_per_page(50)
+            )
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
         
-        return jsonify({"following": following_data}), 200
+        return jsonify({"following": following_data, "next_cursor": cursor}), 200
         
     except Exception as e:
         return jsonify({"error": "Failed to get following list"}), 500
 
+@users.route('/<user_id>/following', methods=['GET'])
+@jwt_required()
+def get_user_following(user_id):
+    try:
+        try:
+            following_data, cursor = follow_list_page(
+                Follow.objects(follower=user_id), 'followee', request.args.get('before'), get_per_page(20)
+            )
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        
+        return jsonify({"following": following_data, "next_cursor": cursor}), 200
+        
+    except Exception as e:
+        return jsonify({"error": "Failed to get following list"}), 500
+
+@users.route('/<user_id>/followers', methods=['GET'])
+@jwt_required()
+def get_user_followers(user_id):
+    try:
+        try:
+            followers_data, cursor = follow_list_page(
+                Follow.objects(followee=user_id), 'follower', request.args.get('before'), get_per_page(20)
+            )
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        
+        return jsonify({"followers": followers_data, "next_cursor": cursor}), 200
+        
+    except Exception as e:
+        return jsonify({"error": "Failed to get followers list"}), 500
+
 @users.route('/<user_id>/follow', methods=['POST'])
 @jwt_required()
 def follow_user(user_id):
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
-        target_user = User.objects(id=user_id).first()
+        current_user = get_user(current_user_id)
+        target_user = get_user(user_id)
         
         if not current_user or not target_user:
             return jsonify({"error": "User not found"}), 404
@@ -87,89 +118,128 @@ def follow_user(user_id):
         if str(current_user_id) == str(user_id):
             return jsonify({"error": "Cannot follow yourself"}), 400
         
-        # Check if already following
-        is_following = str(target_user.id) in [str(following.id) for following in current_user.following]
-        
-        if is_following:
-            # Unfollow
-            current_user.following = [user for user in current_user.following if str(user.id) != str(target_user.id)]
-            target_user.followers = [user for user in target_user.followers if str(user.id) != str(current_user.id)]
-            
-            current_user.save()
-            target_user.save()
-            
-            return jsonify({
-                "message": "Unfollowed successfully",
-                "is_following": False
-            }), 200
-        else:
-            # Follow
-            current_user.following.append(target_user)
-            target_user.followers.append(current_user)
-            
-            current_user.save()
-            target_user.save()
+        # Clients may send the desired state to make retries idempotent; otherwise toggle
+        data = request.get_json(silent=True) or {}
+        desired = data.get('following')
+        
+        if desired is not True:
+            # Unfollow: only the request that removes the edge moves the counters
+            removed = unfollow(current_user.id, target_user.id)
+            if removed:
+                remove_from_timeline(current_user.id, target_user.id)
+            if removed or desired is False:
+                return jsonify({
+                    "message": "Unfollowed successfully",
+                    "is_following": False
+                }), 200
+        
+        # Follow: the unique (follower, followee) index makes concurrent follows count once
+        if follow(current_user.id, target_user.id):
+            backfill_timeline(current_user.id, target_user.id)
+            drop_suggestion(current_user.id, target_user.id)
             
             # Create notification
-            notification = Notification(
-                recipient=target_user,
-                sender=current_user,
-                notification_type='follow'
-            )
-            notification.save()
+            notify(target_user.id, current_user.id, 'follow')
             
             # Emit real-time follow notification
             emit_new_follow(str(current_user_id), str(user_id))
-            
-            return jsonify({
-                "message": "Followed successfully",
-                "is_following": True
-            }), 200
+        
+        return jsonify({
+            "message": "Followed successfully",
+            "is_following": True
+        }), 200
             
     except Exception as e:
         return jsonify({"error": "Failed to follow/unfollow user"}), 500
 
+def profile_header(current_user_id, target_user):
+    """Header fields from the stored counters: no post or follow scans"""
+    return {
+        "id": str(target_user.id),
+        "username": target_user.username,
+        "profile_picture": target_user.profile_picture,
+        "bio": target_user.bio,
+        "followers_count": target_user.followers_count,
+        "following_count": target_user.following_count,
+        "posts_count": target_user.posts_count,
+        "is_following": is_following_user(current_user_id, target_user.id),
+        "is_own_profile": str(current_user_id) == str(target_user.id)
+    }
+
+def profile_posts_page(current_user_id, target_user, before, per_page):
+    """One page of the profile grid; raises ValueError for a bad cursor"""
+    user_posts = Post.objects(author=target_user.id)
+    if str(current_user_id) != str(target_user.id):
+        user_posts = user_posts.filter(status__nin=UNPUBLISHED)
+    posts = list(paginate(user_posts, before, per_page).only(*GRID_POST_FIELDS).as_pymongo())
+    posts_data = [grid_post(post) for post in posts]
+    return posts_data, next_cursor(posts, per_page)
+
+@users.route('/<user_id>/header', methods=['GET'])
+@jwt_required()
+def get_user_header(user_id):
+    try:
+        current_user_id = get_jwt_identity()
+        target_user = get_user(user_id)
+        
+        if not target_user:
+            return jsonify({"error": "User not found"}), 404
+        
+        # The header depends on the viewer (is_following), so it is private and revalidated each view;
+        # an unchanged header comes back as a bodiless 304
+        response = jsonify({"user": profile_header(current_user_id, target_user)})
+        response.add_etag()
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+        
+    except Exception as e:
+        return jsonify({"error": "Failed to get user profile"}), 500
+
+@users.route('/<user_id>/posts', methods=['GET'])
+@jwt_required()
+def get_user_posts(user_id):
+    try:
+        current_user_id = get_jwt_identity()
+        target_user = get_user(user_id)
+        
+        if not target_user:
+            return jsonify({"error": "User not found"}), 404
+        
+        try:
+            posts_data, cursor = profile_posts_page(current_user_id, target_user, request.args.get('before'), get_per_page(12))
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        
+        return jsonify({
+            "posts": posts_data,
+            "next_cursor": cursor
+        }), 200
+        
+    except Exception as e:
+        return jsonify({"error": "Failed to get user posts"}), 500
+
 @users.route('/<user_id>/profile', methods=['GET'])
 @jwt_required()
 def get_user_profile(user_id):
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
-        target_user = User.objects(id=user_id).first()
+        current_user = get_user(current_user_id)
+        target_user = get_user(user_id)
         
         if not current_user or not target_user:
             return jsonify({"error": "User not found"}), 404
         
-        # Check if current user is following target user
-        is_following = str(target_user.id) in [str(following.id) for following in current_user.following]
-        
-        # Get user's posts
-        posts = Post.objects(author=target_user).order_by('-created_at')
-        
-        posts_data = []
-        for post in posts:
-            posts_data.append({
-                "id": str(post.id),
-                "images": post.images,
-                "caption": post.caption,
-                "likes_count": len(post.likes),
-                "comments_count": len(post.comments),
-                "created_at": post.created_at.isoformat()
-            })
+        # Header and first grid page in one response, for clients that predate /header and /posts
+        try:
+            posts_data, cursor = profile_posts_page(current_user_id, target_user, request.args.get('before'), get_per_page(12))
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
         
         return jsonify({
-            "user": {
-                "id": str(target_user.id),
-                "username": target_user.username,
-                "profile_picture": target_user.profile_picture,
-                "bio": target_user.bio,
-                "followers_count": len(target_user.followers),
-                "following_count": len(target_user.following),
-                "posts_count": len(posts_data),
-                "is_following": is_following,
-                "is_own_profile": str(current_user_id) == str(user_id)
-            },
-            "posts": posts_data
+            "user": profile_header(current_user_id, target_user),
+            "posts": posts_data,
+            "next_cursor": cursor
         }), 200
         
     except Exception as e:
@@ -180,39 +250,70 @@ def get_user_profile(user_id):
 def get_user_suggestions():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
         
-        # Get users that the current user is not following
-        following_ids = [str(following.id) for following in current_user.following]
-        following_ids.append(str(current_user_id))
-        
-        # Get random users (limit to 10)
-        suggestions = User.objects(id__nin=following_ids).limit(10)
+        # Precomputed top candidates, best first (suggestions.refresh_all keeps them current)
+        candidates = get_suggestions(current_user.id, current_app.config['SUGGESTIONS_SHOWN'])
+        candidate_ids = [candidate['user'] for candidate in candidates]
+        users_by_id = {
+            user['_id']: user for user in
+            User.objects(id__in=candidate_ids).only(*USER_SUMMARY_FIELDS).as_pymongo()
+        } if candidate_ids else {}
         
-        suggestions_data = []
-        for user in suggestions:
-            suggestions_data.append({
-                "id": str(user.id),
-                "username": user.username,
-                "profile_picture": user.profile_picture,
-                "bio": user.bio,
-                "followers_count": len(user.followers)
-            })
+        suggestions_data = [
+            {**user_summary(users_by_id[candidate['user']]), "mutual_followers": candidate.get('mutual', 0)}
+            for candidate in candidates if candidate['user'] in users_by_id
+        ]
         
         return jsonify({"suggestions": suggestions_data}), 200
         
     except Exception as e:
         return jsonify({"error": "Failed to get suggestions"}), 500
 
+@users.route('/cards/cache-stats', methods=['GET'])
+@jwt_required()
+def get_card_cache_stats():
+    try:
+        # Operational data: only for the ids in OPS_USER_IDS, everyone else sees no such route
+        if get_jwt_identity() not in current_app.config['OPS_USER_IDS']:
+            return jsonify({"error": "Not found"}), 404
+        
+        # Hit rate and size of this worker's user card cache, for sizing USER_CARD_CACHE_SIZE/TTL
+        return jsonify({"card_cache": card_cache_stats()}), 200
+        
+    except Exception as e:
+        return jsonify({"error": "Failed to get cache stats"}), 500
+
+@users.route('/presence', methods=['GET'])
+@jwt_required()
+def get_presence():
+    try:
+        # ?ids=a,b,c -> online flag and last_seen for each
+        user_ids = [user_id for user_id in request.args.get('ids', '').split(',') if user_id.strip()]
+        
+        if not user_ids:
+            return jsonify({"error": "ids is required"}), 400
+        
+        if len(user_ids) > 100:
+            return jsonify({"error": "Maximum 100 ids allowed"}), 400
+        
+        if not all(ObjectId.is_valid(user_id.strip()) for user_id in user_ids):
+            return jsonify({"error": "Invalid user id"}), 400
+        
+        return jsonify({"presence": presence_of(user_id.strip() for user_id in user_ids)}), 200
+        
+    except Exception as e:
+        return jsonify({"error": "Failed to get presence"}), 500
+
 @users.route('/profile', methods=['PUT'])
 @jwt_required()
 def update_profile():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
@@ -245,13 +346,7 @@ def update_profile():
         if delete_profile_picture:
             # Delete existing profile picture
             if current_user.profile_picture:
-                import os
-                try:
-                    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], os.path.basename(current_user.profile_picture))
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                except:
-                    pass  # Ignore file deletion errors
+                remove_upload(current_app.config['UPLOAD_FOLDER'], current_user.profile_picture)
                 current_user.profile_picture = None
         elif 'profile_picture' in request.files:
             file = request.files['profile_picture']
@@ -280,12 +375,7 @@ def update_profile():
                 
                 # Delete old profile picture if exists
                 if current_user.profile_picture:
-                    try:
-                        old_file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], os.path.basename(current_user.profile_picture))
-                        if os.path.exists(old_file_path):
-                            os.remove(old_file_path)
-                    except:
-                        pass
+                    remove_upload(current_app.config['UPLOAD_FOLDER'], current_user.profile_picture)
                 
                 current_user.profile_picture = f"/uploads/{filename}"
         
@@ -293,6 +383,8 @@ def update_profile():
         current_user.username = username
         current_user.bio = bio
         current_user.save()
+        invalidate_user(current_user.id)
+        invalidate_cards(current_user.id)
         
         # Emit profile update to followers
         profile_data = {
@@ -322,7 +414,7 @@ def update_profile():
 def change_email():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
@@ -355,6 +447,7 @@ def change_email():
         # Update email
         current_user.email = new_email
         current_user.save()
+        invalidate_user(current_user.id)
         
         return jsonify({
             "message": "Email changed successfully",
@@ -375,7 +468,7 @@ def change_email():
 def change_password():
     try:
         current_user_id = get_jwt_identity()
-        current_user = User.objects(id=current_user_id).first()
+        current_user = get_user(current_user_id)
         
         if not current_user:
             return jsonify({"error": "User not found"}), 404
@@ -400,6 +493,7 @@ def change_password():
         # Update password
         current_user.set_password(new_password)
         current_user.save()
+        invalidate_user(current_user.id)
         
         return jsonify({
             "message": "Password changed successfully"
@@ -0,0 +1,107 @@
+# search.py
+# Username prefix search on the indexed username_lower field, ranked per viewer
+import time
+import threading
+from collections import OrderedDict
+from flask import current_app
+from models import User, Follow
+from follows import following_among, recent_following_ids
+from hydration import ref_id
+from serializers import USER_SUMMARY_FIELDS, user_summary
+
+_prefixes = OrderedDict()  # prefix -> (expires_at, candidate documents)
+_lock = threading.Lock()
+
+CANDIDATE_FIELDS = USER_SUMMARY_FIELDS + ('username_lower', 'following_count')
+
+def normalize(query):
+    return query.strip().lstrip('@').lower()
+
+def _cached(prefix):
+    """Candidates for prefix from the cache, narrowing a shorter prefix's complete list if possible"""
+    now = time.monotonic()
+    limit = current_app.config['SEARCH_CANDIDATES']
+    with _lock:
+        for length in range(len(prefix), 0, -1):
+            entry = _prefixes.get(prefix[:length])
+            if not entry or entry[0] <= now:
+                continue
+            candidates = entry[1]
+            if length == len(prefix):
+                _prefixes.move_to_end(prefix)
+                return candidates
+            # A shorter prefix that matched fewer than the limit holds every match for this one too
+            if len(candidates) < limit:
+                return [c for c in candidates if c.get('username_lower', c['username'].lower()).startswith(prefix)]
+    return None
+
+def prefix_candidates(prefix):
+    """The SEARCH_CANDIDATES most followed users whose lowercase username starts with prefix, plus an exact match
+
+    Shared by every viewer for SEARCH_CACHE_TTL. The (username_lower, -followers_count) index bounds the
+    scan to the prefix range; the top-N sort over that range is what the cache saves on short prefixes.
+    """
+    candidates = _cached(prefix)
+    if candidates is not None:
+        return candidates
+
+    candidates = list(User.objects(username_lower__startswith=prefix).order_by('-followers_count').only(
+        *CANDIDATE_FIELDS
+    ).limit(current_app.config['SEARCH_CANDIDATES']).as_pymongo())
+    # An exact username ranks first however few followers it has, so it must make the shortlist
+    if not any(c.get('username_lower') == prefix for c in candidates):
+        candidates.extend(User.objects(username_lower=prefix).only(*CANDIDATE_FIELDS).as_pymongo())
+
+    with _lock:
+        _prefixes[prefix] = (time.monotonic() + current_app.config['SEARCH_CACHE_TTL'], candidates)
+        _prefixes.move_to_end(prefix)
+        while len(_prefixes) > current_app.config['SEARCH_CACHE_SIZE']:
+            _prefixes.popitem(last=False)
+    return candidates
+
+def mutual_counts_pipeline(followed, user_ids):
+    """Edges from the followed accounts to user_ids, counted per user"""
+    return [
+        {'$match': {'follower': {'$in': list(followed)}, 'followee': {'$in': list(user_ids)}}},
+        {'$group': {'_id': '$followee', 'count': {'$sum': 1}}}
+    ]
+
+def mutual_counts(viewer_id, user_ids):
+    """For each user id, how many of the viewer's most recent follows also follow them
+
+    Only SEARCH_MUTUAL_SAMPLE followed accounts are counted, so the work is at most that many
+    times the candidates in (follower, followee) index probes, however popular the candidates are.
+    """
+    if not user_ids:
+        return {}
+    followed = recent_following_ids(viewer_id, current_app.config['SEARCH_MUTUAL_SAMPLE'])
+    if not followed:
+        return {}
+    pipeline = mutual_counts_pipeline(followed, user_ids)
+    return {group['_id']: group['count'] for group in Follow._get_collection().aggregate(pipeline)}
+
+def search_users(viewer_id, query):
+    """Ranked matches: exact username first, then mutual follows, then follower count"""
+    prefix = normalize(query)
+    if not prefix:
+        return []
+
+    viewer = ref_id(viewer_id)
+    candidates = [c for c in prefix_candidates(prefix) if c['_id'] != viewer]
+    ids = [c['_id'] for c in candidates]
+    mutual = mutual_counts(viewer, ids)
+    followed = following_among(viewer, ids)
+
+    def rank(candidate):
+        username = candidate.get('username_lower') or candidate['username'].lower()
+        return (username != prefix, -mutual.get(candidate['_id'], 0), -candidate.get('followers_count', 0), username)
+
+    results = []
+    for candidate in sorted(candidates, key=rank)[:current_app.config['SEARCH_RESULTS']]:
+        results.append({
+            **user_summary(candidate),
+            "is_following": candidate['_id'] in followed,
+            "mutual_followers": mutual.get(candidate['_id'], 0),
+            "following_count": candidate.get('following_count', 0)
+        })
+    return results
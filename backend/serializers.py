@@ -0,0 +1,110 @@
+# serializers.py
+# Response shapes built from raw documents, the projections that load exactly their fields, and the JSON encoder
+from flask import current_app
+from flask.json.provider import DefaultJSONProvider
+from media import rendition_map
+
+# Fields each shape reads: pass to .only() (with .as_pymongo()) so reads never load more
+USER_CARD_FIELDS = ('username', 'profile_picture')
+USER_SUMMARY_FIELDS = USER_CARD_FIELDS + ('bio', 'followers_count')
+GRID_POST_FIELDS = ('images', 'image_hashes', 'caption', 'likes_count', 'comments_count', 'status', 'created_at')
+COMMENT_FIELDS = ('author', 'content', 'created_at', 'likes_count', 'parent', 'depth', 'replies_count')
+MESSAGE_FIELDS = ('sender', 'content', 'is_read', 'created_at')
+NOTIFICATION_FIELDS = ('notification_type', 'sender', 'actors', 'actor_count', 'event_count', 'post', 'is_read', 'created_at')
+
+def user_card(user):
+    """Compact public representation of a user"""
+    if isinstance(user, dict):
+        return {
+            "id": str(user['_id']),
+            "username": user.get('username', ''),
+            "profile_picture": user.get('profile_picture', '')
+        }
+    return {
+        "id": str(user.id),
+        "username": user.username,
+        "profile_picture": user.profile_picture
+    }
+
+def user_summary(user):
+    """Card plus bio and follower count, for user lists (raw USER_SUMMARY_FIELDS document)"""
+    return {
+        **user_card(user),
+        "bio": user.get('bio', ''),
+        "followers_count": user.get('followers_count', 0)
+    }
+
+def post_renditions(image_hashes, sizes=None):
+    """Rendition maps for a post's images (empty for posts that predate renditions)"""
+    sizes = sizes or current_app.config['POST_IMAGE_SIZES']
+    return [rendition_map(digest, sizes) for digest in image_hashes or []]
+
+def grid_post(post):
+    """Profile grid tile (raw GRID_POST_FIELDS document)"""
+    return {
+        "id": str(post['_id']),
+        "images": post.get('images', []),
+        "image_renditions": post_renditions(post.get('image_hashes')),
+        "caption": post.get('caption', ''),
+        "likes_count": post.get('likes_count', 0),
+        "comments_count": post.get('comments_count', 0),
+        "status": post.get('status', 'ready'),
+        "created_at": post['created_at'].isoformat()
+    }
+
+def serialize_comment(comment, cards):
+    """Serialize a raw comment document using preloaded author cards"""
+    return {
+        "id": str(comment['_id']),
+        "content": comment['content'],
+        "created_at": comment['created_at'].isoformat(),
+        "likes_count": comment.get('likes_count', 0),
+        "parent_id": str(comment['parent']) if comment.get('parent') else None,
+        "depth": comment.get('depth', 0),
+        "replies_count": comment.get('replies_count', 0),
+        "author": cards.get(str(comment['author']))
+    }
+
+def serialize_message(message, viewer_id):
+    """Chat message as seen by viewer_id (raw MESSAGE_FIELDS document)"""
+    return {
+        "id": str(message['_id']),
+        "content": message['content'],
+        "created_at": message['created_at'].isoformat(),
+        "is_from_me": str(message['sender']) == str(viewer_id),
+        "is_read": message.get('is_read', False)
+    }
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask's JSON provider with orjson doing the encoding
+
+    Datetimes go through Flask's default hook, so they keep Flask's HTTP-date
+    format. Output is equivalent JSON, but non-ASCII text is sent as UTF-8
+    rather than \\u escapes.
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj, **kwargs):
+        orjson = self._orjson
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode()
+
+JSON_BACKENDS = {
+    'stdlib': DefaultJSONProvider,
+    'orjson': OrjsonProvider
+}
+
+def init_json(app):
+    """Install the JSON provider named by JSON_BACKEND"""
+    backend = app.config['JSON_BACKEND']
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f"Unsupported JSON_BACKEND {backend!r}, expected one of {', '.join(JSON_BACKENDS)}")
+    app.json = JSON_BACKENDS[backend](app)
@@ -1,34 +1,64 @@
 # socket_events.py
 from flask_socketio import emit, join_room, leave_room
-from flask import request
+from flask import request, session
 from flask_jwt_extended import decode_token
 from models import User, Post, Comment, Notification, Message
+from fanout import dispatch
+from presence import user_connected, user_disconnected, is_reachable
 from datetime import datetime
+import time
+
+def bind_socket_user(token):
+    """Decode the JWT once and keep the user on this socket's session"""
+    decoded = decode_token(token)
+    user_id = decoded['sub']
+    session['user_id'] = user_id
+    session['token_exp'] = decoded.get('exp')
+    
+    # Join user's personal room
+    join_room(f"user_{user_id}")
+    user_connected(user_id, request.sid)
+    print(f"User {user_id} joined room: user_{user_id}")
+    return user_id
+
+def socket_user_id(data=None):
+    """User bound to this socket, binding it from a token in the payload for older clients"""
+    user_id = session.get('user_id')
+    token_exp = session.get('token_exp')
+    if user_id and (token_exp is None or token_exp > time.time()):
+        return user_id
+    
+    token = data.get('token') if isinstance(data, dict) else None
+    if not token:
+        return None
+    return bind_socket_user(token)
 
 def init_socket_events(socketio):
     @socketio.on('connect')
-    def handle_connect():
+    def handle_connect(auth=None):
         print(f"Client connected: {request.sid}")
+        # Clients that pass {auth: {token}} are authenticated once here
+        token = auth.get('token') if isinstance(auth, dict) else None
+        if token:
+            try:
+                bind_socket_user(token)
+            except Exception as e:
+                print(f"Error authenticating socket: {e}")
+                return False
     
     @socketio.on('disconnect')
     def handle_disconnect():
         print(f"Client disconnected: {request.sid}")
+        try:
+            user_disconnected(request.sid)
+        except Exception as e:
+            print(f"Error updating presence: {e}")
     
     @socketio.on('join_user_room')
     def handle_join_user_room(data):
         try:
-            # Extract token from data
-            token = data.get('token')
-            if not token:
-                return
-            
-            # Decode token to get user ID
-            decoded = decode_token(token)
-            user_id = decoded['sub']
-            
-            # Join user's personal room
-            join_room(f"user_{user_id}")
-            print(f"User {user_id} joined room: user_{user_id}")
+            # Already joined at connect, or bound now from the payload token
+            socket_user_id(data)
             
         except Exception as e:
             print(f"Error joining user room: {e}")
@@ -36,18 +66,15 @@ def init_socket_events(socketio):
     @socketio.on('join_chat_room')
     def handle_join_chat_room(data):
         try:
-            token = data.get('token')
+            user_id = socket_user_id(data)
             partner_id = data.get('partner_id')
             
-            print(f"Join chat room request: token={token[:10]}..., partner_id={partner_id}")
+            print(f"Join chat room request: user={user_id}, partner_id={partner_id}")
             
-            if not token or not partner_id:
-                print("Missing token or partner_id")
+            if not user_id or not partner_id:
+                print("Missing user or partner_id")
                 return
             
-            decoded = decode_token(token)
-            user_id = decoded['sub']
-            
             # Create a unique room name for the chat
             room_name = f"chat_{min(user_id, partner_id)}_{max(user_id, partner_id)}"
             join_room(room_name)
@@ -59,15 +86,12 @@ def init_socket_events(socketio):
     @socketio.on('leave_chat_room')
     def handle_leave_chat_room(data):
         try:
-            token = data.get('token')
+            user_id = socket_user_id(data)
             partner_id = data.get('partner_id')
             
-            if not token or not partner_id:
+            if not user_id or not partner_id:
                 return
             
-            decoded = decode_token(token)
-            user_id = decoded['sub']
-            
             room_name = f"chat_{min(user_id, partner_id)}_{max(user_id, partner_id)}"
             leave_room(room_name)
             print(f"User {user_id} left chat room: {room_name}")
@@ -89,25 +113,69 @@ def emit_new_message(sender_id, receiver_id, message_data):
         print("SocketIO not initialized")
         return
         
-    room_name = f"chat_{min(sender_id, receiver_id)}_{max(sender_id, receiver_id)}"
-    print(f"Emitting new_message to room: {room_name}")
-    
-    # Emit to the chat room - frontend will determine is_from_me based on current user
-    _socketio.emit('new_message', {
-        **message_data,
-        "sender_id": sender_id,
-        "receiver_id": receiver_id
-    }, room=room_name)
-    
-    # Also emit to receiver's personal room for notifications
-    _socketio.emit('new_message_notification', {
-        'sender_id': sender_id,
-        'message': {
+    try:
+        room_name = f"chat_{min(sender_id, receiver_id)}_{max(sender_id, receiver_id)}"
+        print(f"Emitting new_message to room: {room_name}")
+        
+        # Emit to the chat room - frontend will determine is_from_me based on current user
+        _socketio.emit('new_message', {
             **message_data,
-            "is_from_me": False,
-            "partner_id": sender_id
-        }
-    }, room=f"user_{receiver_id}")
+            "sender_id": sender_id,
+            "receiver_id": receiver_id
+        }, room=room_name)
+        
+        # Also emit to receiver's personal room for notifications
+        if not is_reachable(receiver_id):
+            return
+        _socketio.emit('new_message_notification', {
+            'sender_id': sender_id,
+            'message': {
+                **message_data,
+                "is_from_me": False,
+                "partner_id": sender_id
+            }
+        }, room=f"user_{receiver_id}")
+    except Exception as e:
+        print(f"Error emitting new message: {e}")
+
+def emit_post_processed(user_id, post_data):
+    """Emit image processing result to the post author"""
+    if not _socketio:
+        print("SocketIO not initialized")
+        return
+        
+    try:
+        if not is_reachable(user_id):
+            return
+        _socketio.emit('post_processed', post_data, room=f"user_{user_id}")
+    except Exception as e:
+        print(f"Error emitting post processed: {e}")
+
+def emit_profile_picture_processed(user_id, profile_data):
+    """Emit avatar processing result to the user"""
+    if not _socketio:
+        print("SocketIO not initialized")
+        return
+        
+    try:
+        if not is_reachable(user_id):
+            return
+        _socketio.emit('profile_picture_processed', profile_data, room=f"user_{user_id}")
+    except Exception as e:
+        print(f"Error emitting profile picture processed: {e}")
+
+def emit_unread_counts(user_id, counts):
+    """Push the user's unread notification and message counters"""
+    if not _socketio:
+        print("SocketIO not initialized")
+        return
+        
+    try:
+        if not is_reachable(user_id):
+            return
+        _socketio.emit('unread_counts', counts, room=f"user_{user_id}")
+    except Exception as e:
+        print(f"Error emitting unread counts: {e}")
 
 def emit_new_comment(post_id, comment_data):
     """Emit new comment to post author"""
@@ -116,8 +184,8 @@ def emit_new_comment(post_id, comment_data):
         return
         
     try:
-        post = Post.objects(id=post_id).first()
-        if post:
+        post = Post.objects(id=post_id).only('author').first()
+        if post and is_reachable(post.author.id):
             print(f"Emitting new_comment to user: {post.author.id}")
             _socketio.emit('new_comment', {
                 'post_id': str(post_id),
@@ -133,6 +201,8 @@ def emit_new_like(post_id, liker_id, post_author_id):
         return
         
     try:
+        if not is_reachable(post_author_id):
+            return
         print(f"Emitting new_like to user: {post_author_id}")
         _socketio.emit('new_like', {
             'post_id': str(post_id),
@@ -148,6 +218,8 @@ def emit_new_follow(follower_id, followed_id):
         return
         
     try:
+        if not is_reachable(followed_id):
+            return
         print(f"Emitting new_follow to user: {followed_id}")
         _socketio.emit('new_follow', {
             'follower_id': str(follower_id)
@@ -157,34 +229,19 @@ def emit_new_follow(follower_id, followed_id):
 
 def emit_profile_update(user_id, profile_data):
     """Emit profile update to user's followers"""
-    if not _socketio:
-        print("SocketIO not initialized")
-        return
-        
-    try:
-        user = User.objects(id=user_id).first()
-        if user:
-            for follower in user.followers:
-                _socketio.emit('profile_update', {
-                    'user_id': str(user_id),
-                    'profile_data': profile_data
-                }, room=f"user_{follower.id}")
-    except Exception as e:
-        print(f"Error emitting profile update: {e}")
+    dispatch('profile_update', user_id, {
+        'user_id': str(user_id),
+        'profile_data': profile_data
+    }, key=('profile_update', str(user_id)))
 
 def emit_post_update(post_id, post_data):
     """Emit post update to post author's followers"""
-    if not _socketio:
-        print("SocketIO not initialized")
-        return
-        
     try:
-        post = Post.objects(id=post_id).first()
+        post = Post.objects(id=post_id).only('author').first()
         if post:
-            for follower in post.author.followers:
-                _socketio.emit('post_update', {
-                    'post_id': str(post_id),
-                    'post_data': post_data
-                }, room=f"user_{follower.id}")
+            dispatch('post_update', post.author.id, {
+                'post_id': str(post_id),
+                'post_data': post_data
+            }, key=('post_update', str(post_id)))
     except Exception as e:
-        print(f"Error emitting post update: {e}") 
\ No newline at end of file
+        print(f"Error emitting post update: {e}")
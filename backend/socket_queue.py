@@ -0,0 +1,144 @@
+# socket_queue.py
+# Cross-process Socket.IO message queue: external backends via Flask-SocketIO, or a local TCP broker
+import pickle
+import socket
+import struct
+import threading
+import socketserver
+from urllib.parse import urlparse
+from socketio import PubSubManager
+
+ROLE_PUBLISH = b'P'
+ROLE_SUBSCRIBE = b'S'
+
+def _send_frame(sock, payload):
+    sock.sendall(struct.pack('!I', len(payload)) + payload)
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def _recv_frame(sock):
+    (size,) = struct.unpack('!I', _recv_exact(sock, 4))
+    return _recv_exact(sock, size)
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        broker = self.server
+        role = _recv_exact(self.request, 1)
+        if role == ROLE_SUBSCRIBE:
+            with broker.lock:
+                broker.subscribers[self.request] = threading.Lock()
+            # Keep the connection open until the subscriber goes away
+            try:
+                while self.request.recv(1):
+                    pass
+            except OSError:
+                pass
+            finally:
+                with broker.lock:
+                    broker.subscribers.pop(self.request, None)
+            return
+
+        try:
+            while True:
+                frame = _recv_frame(self.request)
+                with broker.lock:
+                    subscribers = list(broker.subscribers.items())
+                for subscriber, send_lock in subscribers:
+                    try:
+                        with send_lock:
+                            _send_frame(subscriber, frame)
+                    except OSError:
+                        with broker.lock:
+                            broker.subscribers.pop(subscriber, None)
+        except (ConnectionError, OSError):
+            pass
+
+class LocalBroker(socketserver.ThreadingTCPServer):
+    """Minimal pub/sub broker that relays every published frame to every subscriber
+
+    Stands in for Redis/RabbitMQ on a single host and in tests.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 5555)):
+        super().__init__(address, _BrokerHandler)
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+def start_local_broker(host='127.0.0.1', port=0):
+    """Run a LocalBroker in a daemon thread; returns the broker and its local:// URL"""
+    broker = LocalBroker((host, port))
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    bound_host, bound_port = broker.server_address
+    return broker, f"local://{bound_host}:{bound_port}"
+
+class LocalSocketManager(PubSubManager):
+    """Socket.IO client manager that publishes through a LocalBroker"""
+    name = 'local'
+
+    def __init__(self, url='local://127.0.0.1:5555', channel='socketio', write_only=False, logger=None):
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or '127.0.0.1', parsed.port or 5555)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _connect(self, role):
+        sock = socket.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(role)
+        return sock
+
+    def _publish(self, data):
+        payload = pickle.dumps(data)
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect(ROLE_PUBLISH)
+                    _send_frame(self._publisher, payload)
+                    return
+                except OSError:
+                    # Reconnect once if the broker restarted
+                    self._publisher = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect(ROLE_SUBSCRIBE)
+                while True:
+                    yield _recv_frame(sock)
+            except (ConnectionError, OSError):
+                self._get_logger().error('Lost connection to the local broker, retrying')
+                self.server.sleep(1)
+
+def socketio_queue_options(config):
+    """SocketIO keyword arguments for the configured SOCKETIO_MESSAGE_QUEUE"""
+    url = config.get('SOCKETIO_MESSAGE_QUEUE')
+    if not url:
+        return {}
+    if url.startswith('local://'):
+        return {'client_manager': LocalSocketManager(url, channel=config['SOCKETIO_CHANNEL'])}
+    # redis://, amqp:// and other Kombu URLs are handled by Flask-SocketIO itself
+    return {'message_queue': url, 'channel': config['SOCKETIO_CHANNEL']}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the local Socket.IO message broker")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    args = parser.parse_args()
+
+    print(f"Local Socket.IO broker listening on {args.host}:{args.port}")
+    LocalBroker((args.host, args.port)).serve_forever()
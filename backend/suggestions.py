@@ -0,0 +1,123 @@
+# suggestions.py
+# Follow suggestions scored offline over the follow graph and stored per user, top candidates first
+from datetime import datetime, timedelta
+from flask import current_app
+from pymongo import UpdateOne
+from models import User, Follow, Post, UserSuggestions
+from hydration import ref_id
+from follows import recent_following_ids
+from timeline import UNPUBLISHED
+
+def recent_following(user_id):
+    """The accounts the user followed most recently, capped at SUGGESTIONS_FOLLOWING_SAMPLE"""
+    return recent_following_ids(user_id, current_app.config['SUGGESTIONS_FOLLOWING_SAMPLE'])
+
+def friends_of_friends_pipeline(following, excluded, limit):
+    return [
+        {'$match': {'follower': {'$in': list(following)}, 'followee': {'$nin': list(excluded)}}},
+        {'$group': {'_id': '$followee', 'mutual': {'$sum': 1}}},
+        {'$sort': {'mutual': -1, '_id': 1}},
+        {'$limit': limit}
+    ]
+
+def friends_of_friends(user_id, following, excluded, limit):
+    """Accounts followed by the people the user follows, with how many of them follow each"""
+    if not following:
+        return {}
+    pipeline = friends_of_friends_pipeline(following, excluded, limit)
+    return {group['_id']: group['mutual'] for group in Follow._get_collection().aggregate(pipeline)}
+
+def recent_post_counts_pipeline(user_ids, since):
+    return [
+        {'$match': {'author': {'$in': list(user_ids)}, 'created_at': {'$gte': since}, 'status': {'$nin': UNPUBLISHED}}},
+        {'$group': {'_id': '$author', 'posts': {'$sum': 1}}}
+    ]
+
+def recent_post_counts(user_ids):
+    """Posts each user published within SUGGESTIONS_ACTIVE_DAYS"""
+    if not user_ids:
+        return {}
+    since = datetime.utcnow() - timedelta(days=current_app.config['SUGGESTIONS_ACTIVE_DAYS'])
+    pipeline = recent_post_counts_pipeline(user_ids, since)
+    return {group['_id']: group['posts'] for group in Post._get_collection().aggregate(pipeline)}
+
+def popular_accounts(limit):
+    """Most-followed accounts, to fill lists for users with a thin follow graph"""
+    users = User.objects.order_by('-followers_count').only('id').limit(limit).as_pymongo()
+    return [user['_id'] for user in users]
+
+def compute_suggestions(user_id, popular=None):
+    """Score candidates for one user: mutual follows, recent activity, and whether they follow back"""
+    config = current_app.config
+    user = ref_id(user_id)
+    stored = config['SUGGESTIONS_STORED']
+    following = recent_following(user)
+    # Exclude everyone followed, not only the sample walked for candidates
+    excluded = set(edge['followee'] for edge in Follow.objects(follower=user).only('followee').as_pymongo())
+    excluded.add(user)
+
+    # Over-fetch so activity can reorder candidates with similar mutual counts
+    mutual = friends_of_friends(user, following, list(excluded), stored * 4)
+    if len(mutual) < stored:
+        for candidate in popular if popular is not None else popular_accounts(stored + len(excluded)):
+            if candidate not in excluded and candidate not in mutual:
+                mutual[candidate] = 0
+
+    candidates = list(mutual)
+    activity = recent_post_counts(candidates)
+    follows_back = {
+        edge['follower'] for edge in
+        Follow.objects(follower__in=candidates, followee=user).only('follower').as_pymongo()
+    } if candidates else set()
+
+    scored = []
+    for candidate in candidates:
+        score = mutual[candidate]
+        score += config['SUGGESTIONS_ACTIVITY_WEIGHT'] * min(activity.get(candidate, 0), config['SUGGESTIONS_ACTIVITY_CAP'])
+        if candidate in follows_back:
+            score += config['SUGGESTIONS_FOLLOWS_YOU_BONUS']
+        scored.append({'user': candidate, 'score': score, 'mutual': mutual[candidate]})
+    scored.sort(key=lambda entry: (-entry['score'], -entry['mutual'], entry['user']))
+    return scored[:stored]
+
+def _store(user_id, candidates):
+    return UpdateOne(
+        {'_id': ref_id(user_id)},
+        {'$set': {'candidates': candidates, 'refreshed_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+def refresh_suggestions(user_id):
+    """Recompute and store one user's suggestions"""
+    candidates = compute_suggestions(user_id)
+    UserSuggestions._get_collection().bulk_write([_store(user_id, candidates)])
+    return candidates
+
+def refresh_all(batch_size=500):
+    """Batch job: recompute every user's suggestions, writing in bulk"""
+    collection = UserSuggestions._get_collection()
+    popular = popular_accounts(current_app.config['SUGGESTIONS_STORED'] * 2)
+    writes = []
+    refreshed = 0
+    for user in User.objects.only('id').as_pymongo().batch_size(batch_size):
+        writes.append(_store(user['_id'], compute_suggestions(user['_id'], popular)))
+        if len(writes) >= batch_size:
+            collection.bulk_write(writes, ordered=False)
+            refreshed += len(writes)
+            writes = []
+    if writes:
+        collection.bulk_write(writes, ordered=False)
+        refreshed += len(writes)
+    return refreshed
+
+def get_suggestions(user_id, limit):
+    """Top stored candidates: one read by _id, computed on demand for users the job hasn't reached"""
+    stored = UserSuggestions.objects(id=ref_id(user_id)).only('candidates').as_pymongo().first()
+    candidates = stored['candidates'] if stored else refresh_suggestions(user_id)
+    return candidates[:limit]
+
+def drop_suggestion(user_id, candidate_id):
+    """Remove an account the user just followed, so the stored list stays valid until the next refresh"""
+    UserSuggestions.objects(id=ref_id(user_id)).update_one(__raw__={
+        '$pull': {'candidates': {'user': ref_id(candidate_id)}}
+    })
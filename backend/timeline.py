@@ -0,0 +1,102 @@
+# timeline.py
+# Materialized per-user feed timelines (fan-out-on-write with a pull path for large accounts)
+import time
+import threading
+from flask import current_app
+from pymongo.errors import BulkWriteError
+from models import User, Post, TimelineEntry
+from pagination import paginate
+from follows import following_ids, following_among, follower_ids
+
+# Posts in these states are not shown in feeds (legacy posts have no status at all)
+UNPUBLISHED = ['processing', 'failed']
+
+_high_fanout = {'expires_at': 0.0, 'ids': []}  # Flagged authors, shared by every feed read in this process
+_lock = threading.Lock()
+
+def high_fanout_ids():
+    """Ids of authors whose posts are pulled, refreshed every FEED_HIGH_FANOUT_CACHE_TTL seconds"""
+    now = time.monotonic()
+    with _lock:
+        if _high_fanout['expires_at'] > now:
+            return _high_fanout['ids']
+    ids = list(User.objects(is_high_fanout=True).scalar('id'))
+    with _lock:
+        _high_fanout['ids'] = ids
+        _high_fanout['expires_at'] = now + current_app.config['FEED_HIGH_FANOUT_CACHE_TTL']
+    return ids
+
+def _insert_entries(entries):
+    """Bulk insert timeline entries, ignoring ones that already exist"""
+    if not entries:
+        return
+    try:
+        TimelineEntry._get_collection().insert_many(entries, ordered=False)
+    except BulkWriteError:
+        pass  # Duplicate (owner, post) pairs are expected on retries and backfills
+
+def fan_out_post(post):
+    """Push a new post into the timelines of the author and their followers"""
+    author_id = post.author.id
+    author = User.objects(id=author_id).only('followers_count', 'is_high_fanout').first()
+
+    # Large accounts are only written to their own timeline; readers pull their posts instead.
+    # The flag never clears: posts published while it was set exist in no follower's timeline,
+    # so dropping back under the limit must not take the author off the pull path.
+    high_fanout = author is not None and (
+        author.is_high_fanout or author.followers_count > current_app.config['FEED_FANOUT_FOLLOWER_LIMIT']
+    )
+    if high_fanout and not author.is_high_fanout:
+        User.objects(id=author_id).update_one(set__is_high_fanout=True)
+        with _lock:
+            _high_fanout['expires_at'] = 0.0
+
+    owners = [author_id]
+    if not high_fanout:
+        owners.extend(follower_ids(author_id))
+
+    _insert_entries([{
+        'owner': owner_id,
+        'post': post.id,
+        'author': author_id,
+        'created_at': post.created_at
+    } for owner_id in owners])
+
+def backfill_timeline(follower_id, followee_id):
+    """Copy a newly followed user's recent posts into the follower's timeline"""
+    limit = current_app.config['FEED_BACKFILL_POSTS']
+    recent = Post.objects(author=followee_id, status__nin=UNPUBLISHED).order_by('-created_at').only('id', 'created_at').limit(limit)
+    _insert_entries([{
+        'owner': follower_id,
+        'post': post.id,
+        'author': followee_id,
+        'created_at': post.created_at
+    } for post in recent])
+
+def remove_from_timeline(follower_id, followee_id):
+    """Drop an unfollowed user's posts from the follower's timeline"""
+    TimelineEntry.objects(owner=follower_id, author=followee_id).delete()
+
+def rebuild_timeline(user_id):
+    """Materialize a timeline for users whose feed predates fan-out (manage.py rebuild-timelines)"""
+    for followee_id in following_ids(user_id) + [user_id]:
+        backfill_timeline(user_id, followee_id)
+
+def get_timeline_page(user_id, cursor, per_page):
+    """Return (post_id, created_at) pairs for one feed page, newest first"""
+    # Followed accounts that are too large to fan out are read directly: the small flagged set
+    # intersected with the viewer's edges on the unique (follower, followee) index
+    pulled_authors = list(following_among(user_id, high_fanout_ids()))
+
+    entries = paginate(TimelineEntry.objects(owner=user_id), cursor, per_page, id_field='post')
+    page = [(entry['post'], entry['created_at']) for entry in entries.only('post', 'created_at').as_pymongo()]
+
+    if pulled_authors:
+        # Merge the materialized timeline with the pulled posts
+        pulled = paginate(Post.objects(author__in=pulled_authors, status__nin=UNPUBLISHED), cursor, per_page)
+        merged = dict(page)
+        for post in pulled.only('id', 'created_at').as_pymongo():
+            merged[post['_id']] = post['created_at']
+        page = sorted(merged.items(), key=lambda item: (item[1], item[0]), reverse=True)[:per_page]
+
+    return page
@@ -0,0 +1,50 @@
+# unread.py
+# Per-user unread counters for notifications and messages, pushed to the user's socket room on change
+from pymongo import ReturnDocument
+from models import UnreadCounter, Notification, Conversation
+from hydration import ref_id
+from socket_events import emit_unread_counts
+
+FIELDS = ('notifications', 'messages')
+
+def _counts(doc):
+    return {field: max(0, doc.get(field, 0)) for field in FIELDS}
+
+def recount_unread(user_id):
+    """Rebuild a user's counters from the notifications and conversation summaries"""
+    user_id = ref_id(user_id)
+    summaries = Conversation.objects(participants=user_id).only('unread_counts').as_pymongo()
+    counts = {
+        'notifications': Notification.objects(recipient=user_id, is_read=False).count(),
+        'messages': sum(summary.get('unread_counts', {}).get(str(user_id), 0) for summary in summaries)
+    }
+    UnreadCounter._get_collection().update_one({'_id': user_id}, {'$set': counts}, upsert=True)
+    return counts
+
+def get_unread_counts(user_id):
+    """Both counters with one primary-key read; built from the source collections the first time"""
+    doc = UnreadCounter._get_collection().find_one({'_id': ref_id(user_id)})
+    if doc is None:
+        return recount_unread(user_id)
+    return _counts(doc)
+
+def _apply(user_id, update):
+    collection = UnreadCounter._get_collection()
+    doc = collection.find_one_and_update({'_id': ref_id(user_id)}, update, return_document=ReturnDocument.AFTER)
+    if doc is None:
+        # No counters yet: start from the real totals, which already include this change
+        counts = recount_unread(user_id)
+    else:
+        for field in FIELDS:
+            if doc.get(field, 0) < 0:
+                collection.update_one({'_id': doc['_id'], field: {'$lt': 0}}, {'$set': {field: 0}})
+        counts = _counts(doc)
+    emit_unread_counts(str(user_id), counts)
+    return counts
+
+def change_unread(user_id, notifications=0, messages=0):
+    """Add to (or with negative values, subtract from) a user's counters"""
+    changes = {field: value for field, value in (('notifications', notifications), ('messages', messages)) if value}
+    if not changes:
+        return None
+    return _apply(user_id, {'$inc': changes})
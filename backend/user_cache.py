@@ -0,0 +1,67 @@
+# user_cache.py
+# User documents memoized per request and cached for a few seconds across requests
+import time
+import threading
+from collections import OrderedDict
+from flask import g, current_app, has_app_context
+from flask_jwt_extended import get_jwt_identity
+from models import User
+
+_entries = OrderedDict()  # user id -> (expires_at, raw document)
+_lock = threading.Lock()
+
+def _request_cache():
+    if not has_app_context():
+        return None
+    if 'user_cache' not in g:
+        g.user_cache = {}
+    return g.user_cache
+
+def get_user(user_id):
+    """User for user_id, or None
+
+    Each call gets its own Document rebuilt from the cached raw document, so a
+    route that modifies and saves its copy cannot leak changes into the cache.
+    """
+    user_id = str(user_id)
+    request_cache = _request_cache()
+    if request_cache is not None and user_id in request_cache:
+        return request_cache[user_id]
+
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(user_id)
+        if entry and entry[0] > now:
+            _entries.move_to_end(user_id)
+            son = entry[1]
+        else:
+            son = None
+
+    if son is None:
+        user = User.objects(id=user_id).first()
+        if user is not None:
+            ttl = current_app.config['USER_CACHE_TTL']
+            with _lock:
+                _entries[user_id] = (now + ttl, user.to_mongo())
+                _entries.move_to_end(user_id)
+                while len(_entries) > current_app.config['USER_CACHE_SIZE']:
+                    _entries.popitem(last=False)
+    else:
+        user = User._from_son(son)
+
+    if request_cache is not None:
+        request_cache[user_id] = user
+    return user
+
+def current_user():
+    """The user behind the request's JWT"""
+    return get_user(get_jwt_identity())
+
+def invalidate_user(*user_ids):
+    """Drop cached copies after the user document changes"""
+    request_cache = _request_cache()
+    with _lock:
+        for user_id in user_ids:
+            _entries.pop(str(user_id), None)
+            if request_cache is not None:
+                request_cache.pop(str(user_id), None)